@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the personal data logging and hashing paths
+
+Runs offline: log lines are generated and written to os.devnull.
+
+Usage: ./benchmark.py [-n ITERATIONS] [--bcrypt-costs 4,6,8]
+                      [-o results.json] [--compare baseline.json]
+"""
+from typing import Callable, Dict, List
+import argparse
+import contextlib
+import datetime
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+import encrypt_password
+import filtered_logger
+from filtered_logger import PII_FIELDS, RedactingFormatter, filter_datum
+
+MESSAGE_SIZES = (5, 20, 100)
+FIELD_COUNTS = (1, 5, 20)
+HIT_RATES = (0.0, 0.5, 1.0)
+HANDLER_TYPES = ("stream", "queued")
+BCRYPT_COSTS = (4, 6, 8, 10)
+ALLOC_SAMPLES = 50
+
+
+def make_fields(count: int) -> List[str]:
+    """Returns count field names to redact, PII_FIELDS first"""
+    extra = ("extra{}".format(i) for i in itertools.count())
+    return list(itertools.islice(itertools.chain(PII_FIELDS, extra), count))
+
+
+def make_message(rng: random.Random, pairs: int, fields: List[str],
+                 hit_rate: float) -> str:
+    """Returns a key=value; log line
+
+    Args:
+        rng (random.Random): seeded generator
+        pairs (int): number of key=value pairs
+        fields (List[str]): redacted fields, used for the hits
+        hit_rate (float): share of the pairs holding a redacted field
+    """
+    items = []
+    for i in range(pairs):
+        if rng.random() < hit_rate:
+            key = rng.choice(fields)
+        else:
+            key = "attr{}".format(i)
+        value = "".join(rng.choices(string.ascii_letters + string.digits,
+                                    k=12))
+        items.append("{}={};".format(key, value))
+    return "".join(items)
+
+
+def measure(func: Callable[[], object], iterations: int) -> Dict:
+    """Times func and samples its allocations
+
+    Returns:
+        Dict: ops_per_sec, p50_us, p99_us and alloc_peak_bytes, the
+              median of the peak traced memory of one call
+    """
+    func()
+    latencies = []
+    clock = time.perf_counter_ns
+    for _ in range(iterations):
+        start = clock()
+        func()
+        latencies.append(clock() - start)
+    latencies.sort()
+
+    peaks = []
+    for _ in range(min(ALLOC_SAMPLES, iterations)):
+        tracemalloc.start()
+        func()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    peaks.sort()
+
+    total = sum(latencies)
+    return {
+        "ops_per_sec": iterations * 1e9 / total if total else 0.0,
+        "p50_us": latencies[len(latencies) // 2] / 1e3,
+        "p99_us": latencies[min(len(latencies) - 1,
+                                int(len(latencies) * 0.99))] / 1e3,
+        "alloc_peak_bytes": peaks[len(peaks) // 2],
+    }
+
+
+def measure_pipeline(emit: Callable[[], object], drain: Callable[[], object],
+                     iterations: int, rounds: int = 5) -> Dict:
+    """Times iterations calls of emit followed by drain, in each round
+
+    Returns:
+        Dict: ops_per_sec, the median throughput of the rounds,
+              round_median_us and round_max_us, the median and worst
+              mean time per record of the rounds (not latency
+              percentiles), and alloc_peak_bytes, the peak traced memory
+              of a round of ALLOC_SAMPLES records
+    """
+    def run(count: int) -> int:
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            emit()
+        drain()
+        return time.perf_counter_ns() - start
+
+    run(min(ALLOC_SAMPLES, iterations))
+    per_record = sorted(run(iterations) / iterations for _ in range(rounds))
+    tracemalloc.start()
+    run(min(ALLOC_SAMPLES, iterations))
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    median = per_record[len(per_record) // 2]
+    return {
+        "ops_per_sec": 1e9 / median if median else 0.0,
+        "round_median_us": median / 1e3,
+        "round_max_us": per_record[-1] / 1e3,
+        "alloc_peak_bytes": peak,
+    }
+
+
+def make_record(message: str) -> logging.LogRecord:
+    """Returns a record as logged by the user_data logger"""
+    return logging.LogRecord("user_data", logging.INFO, __file__, 0,
+                             message, None, None)
+
+
+@contextlib.contextmanager
+def stderr_to_devnull():
+    """Sends sys.stderr, where get_logger writes, to os.devnull"""
+    stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = stderr
+
+
+def bench_redaction(iterations: int, seed: int) -> List[Dict]:
+    """filter_datum and RedactingFormatter.format over the message grid"""
+    results = []
+    grid = itertools.product(MESSAGE_SIZES, FIELD_COUNTS, HIT_RATES)
+    for pairs, field_count, hit_rate in grid:
+        rng = random.Random(seed)
+        fields = make_fields(field_count)
+        message = make_message(rng, pairs, fields, hit_rate)
+        params = {"pairs": pairs, "fields": field_count,
+                  "hit_rate": hit_rate}
+
+        stats = measure(lambda: filter_datum(fields, "***", message, ";"),
+                        iterations)
+        results.append(dict(name="filter_datum", params=params, **stats))
+
+        formatter = RedactingFormatter(fields)
+        record = make_record(message)
+        stats = measure(lambda: formatter.format(record), iterations)
+        results.append(dict(name="RedactingFormatter.format",
+                            params=params, **stats))
+    return results
+
+
+def bench_logger(iterations: int, seed: int) -> List[Dict]:
+    """logger.info through get_logger for each handler type
+
+    get_logger.info is the throughput of the whole pipeline: records are
+    logged then the queue is drained, so redaction and writing are
+    timed whatever the handler. get_logger.info.caller is the latency
+    seen by the caller, which only enqueues with the queued handler.
+    """
+    results = []
+    rng = random.Random(seed)
+    for handler_type, pairs in itertools.product(HANDLER_TYPES,
+                                                 MESSAGE_SIZES):
+        message = make_message(rng, pairs, list(PII_FIELDS), 0.5)
+        params = {"handler": handler_type, "pairs": pairs}
+        with stderr_to_devnull():
+            filtered_logger.shutdown_logger()
+            logger = filtered_logger.get_logger(
+                queued=handler_type == "queued")
+            handler = logger.handlers[0]
+            log_queue = getattr(handler, "queue", None)
+            drain = log_queue.join if log_queue is not None \
+                else handler.flush
+            stats = measure_pipeline(lambda: logger.info(message), drain,
+                                     iterations)
+            results.append(dict(name="get_logger.info", params=params,
+                                **stats))
+            stats = measure(lambda: logger.info(message), iterations)
+            drain()
+            results.append(dict(name="get_logger.info.caller",
+                                params=params, **stats))
+            filtered_logger.shutdown_logger()
+    return results
+
+
+def bench_bcrypt(costs: List[int], iterations: int) -> List[Dict]:
+    """hash_password and is_valid at each bcrypt cost"""
+    results = []
+    for cost in costs:
+        hashed = encrypt_password.hash_password("benchmark", cost)
+        stats = measure(
+            lambda: encrypt_password.hash_password("benchmark", cost),
+            iterations)
+        results.append(dict(name="hash_password", params={"cost": cost},
+                            **stats))
+        stats = measure(lambda: encrypt_password.is_valid(hashed,
+                                                          "benchmark"),
+                        iterations)
+        results.append(dict(name="is_valid", params={"cost": cost},
+                            **stats))
+    return results
+
+
+def result_key(result: Dict) -> str:
+    """Returns the name identifying a result across runs"""
+    params = ",".join("{}={}".format(key, value)
+                      for key, value in sorted(result["params"].items()))
+    return "{}[{}]".format(result["name"], params)
+
+
+def format_result(result: Dict) -> str:
+    """Returns the report line of a result"""
+    if "p50_us" in result:
+        timings = "p50 {:>10.1f}us  p99 {:>10.1f}us".format(
+            result["p50_us"], result["p99_us"])
+    else:
+        timings = "round median {:>7.1f}us  max {:>7.1f}us".format(
+            result["round_median_us"], result["round_max_us"])
+    return "{:<70} {:>12.0f} ops/s  {}  {:>8} B".format(
+        result_key(result), result["ops_per_sec"], timings,
+        result["alloc_peak_bytes"])
+
+
+def compare(results: List[Dict], baseline: List[Dict]):
+    """Prints the ops/sec ratio of each result against a baseline run"""
+    previous = {result_key(result): result for result in baseline}
+    for result in results:
+        before = previous.get(result_key(result))
+        if before is None or not before["ops_per_sec"]:
+            continue
+        ratio = result["ops_per_sec"] / before["ops_per_sec"]
+        print("{:<70} {:>7.2f}x".format(result_key(result), ratio))
+
+
+def main():
+    """Runs the benchmarks and reports the results"""
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("-n", "--iterations", type=int, default=2000)
+    parser.add_argument("--bcrypt-iterations", type=int, default=5)
+    parser.add_argument("--bcrypt-costs", default=",".join(
+        str(cost) for cost in BCRYPT_COSTS))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    costs = [int(cost) for cost in args.bcrypt_costs.split(",") if cost]
+    results = bench_redaction(args.iterations, args.seed)
+    results += bench_logger(args.iterations, args.seed)
+    results += bench_bcrypt(costs, args.bcrypt_iterations)
+
+    for result in results:
+        print(format_result(result))
+
+    if args.output:
+        run = {
+            "meta": {
+                "date": datetime.datetime.utcnow().isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "iterations": args.iterations,
+                "seed": args.seed,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == '__main__':
+    main()
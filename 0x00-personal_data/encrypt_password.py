@@ -2,14 +2,164 @@
 """
 Encrypt Password Module
 """
+from typing import Iterable, List, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+import asyncio
+import os
+import threading
+import time
 import bcrypt
 
+MAX_CONCURRENCY = os.cpu_count() or 1
+MIN_ROUNDS = 4
+MAX_ROUNDS = 31
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
 
-def hash_password(password: str) -> bytes:
-    """ Hash a password using bcrypt """
-    return bcrypt.hashpw(password.encode(), bcrypt.gensalt())
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def hash_password(password: str, rounds: int = None) -> bytes:
+    """ Hash a password using bcrypt, at BCRYPT_ROUNDS by default """
+    return bcrypt.hashpw(password.encode(),
+                         bcrypt.gensalt(rounds or BCRYPT_ROUNDS))
 
 
 def is_valid(hashed_password: bytes, password: str) -> bool:
     """ Check if a hashed password matches the input password """
     return bcrypt.checkpw(password.encode(), hashed_password)
+
+
+def hash_cost(hashed_password: bytes) -> int:
+    """ Returns the cost factor of a bcrypt hash ($2b$<cost>$...) """
+    return int(hashed_password.split(b"$")[2])
+
+
+def needs_rehash(hashed_password: bytes, rounds: int = None) -> bool:
+    """ Check if a hash uses a lower cost than BCRYPT_ROUNDS """
+    return hash_cost(hashed_password) < (rounds or BCRYPT_ROUNDS)
+
+
+def verify_and_rehash(hashed_password: bytes,
+                      password: str) -> Tuple[bool, Optional[bytes]]:
+    """ Check a password and upgrade its hash when outdated
+
+    Returns:
+        Tuple[bool, Optional[bytes]]: is_valid result, and a new hash at
+                                      BCRYPT_ROUNDS to store when the
+                                      password is valid but its hash
+                                      needs_rehash, None otherwise
+    """
+    if not is_valid(hashed_password, password):
+        return False, None
+    if needs_rehash(hashed_password):
+        return True, hash_password(password)
+    return True, None
+
+
+def calibrate_cost(target_seconds: float = 0.25, min_rounds: int = 10,
+                   max_rounds: int = MAX_ROUNDS) -> int:
+    """ Returns the highest cost verifying within target_seconds here
+
+    Each cost step doubles the work, so costs are timed upward from
+    MIN_ROUNDS and the search stops at the first one over the target.
+    The result is never below min_rounds. Assign it to BCRYPT_ROUNDS to
+    hash new passwords at that cost.
+
+    Args:
+        target_seconds (float): verify latency budget
+        min_rounds (int): lowest acceptable cost
+        max_rounds (int): highest cost tried
+
+    Returns:
+        int: the cost factor
+    """
+    password = b"calibration"
+    best = MIN_ROUNDS
+    for rounds in range(MIN_ROUNDS, max_rounds + 1):
+        hashed = bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+        start = time.perf_counter()
+        bcrypt.checkpw(password, hashed)
+        if time.perf_counter() - start > target_seconds:
+            break
+        best = rounds
+    return max(best, min_rounds)
+
+
+def _is_valid_pair(pair: Tuple[bytes, str]) -> bool:
+    """ is_valid over a (hashed_password, password) pair """
+    return is_valid(*pair)
+
+
+def hash_passwords(passwords: Iterable[str],
+                   workers: int = None) -> List[bytes]:
+    """ Hash passwords in a process pool, keeping their order
+
+    Args:
+        passwords (Iterable[str]): the passwords to hash
+        workers (int): number of processes, one per CPU by default
+
+    Returns:
+        List[bytes]: the hashed passwords
+    """
+    passwords = list(passwords)
+    workers = min(workers or MAX_CONCURRENCY, len(passwords))
+    if workers <= 1:
+        return [hash_password(password) for password in passwords]
+    with ProcessPoolExecutor(workers) as executor:
+        chunksize = max(1, len(passwords) // (workers * 4))
+        return list(executor.map(hash_password, passwords,
+                                 chunksize=chunksize))
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: int = None) -> List[bool]:
+    """ Check passwords against their hashes in a process pool
+
+    Args:
+        pairs (Iterable[Tuple[bytes, str]]): (hashed_password, password)
+        workers (int): number of processes, one per CPU by default
+
+    Returns:
+        List[bool]: is_valid result of each pair, in order
+    """
+    pairs = list(pairs)
+    workers = min(workers or MAX_CONCURRENCY, len(pairs))
+    if workers <= 1:
+        return [_is_valid_pair(pair) for pair in pairs]
+    with ProcessPoolExecutor(workers) as executor:
+        chunksize = max(1, len(pairs) // (workers * 4))
+        return list(executor.map(_is_valid_pair, pairs,
+                                 chunksize=chunksize))
+
+
+def get_executor() -> Executor:
+    """ Returns the executor of the awaitable variants
+
+    bcrypt releases the GIL while hashing, so a thread pool of
+    MAX_CONCURRENCY threads bounds the number of concurrent hashes
+    without blocking the event loop.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(MAX_CONCURRENCY,
+                                           thread_name_prefix="bcrypt")
+        return _executor
+
+
+async def hash_password_async(password: str,
+                              executor: Executor = None) -> bytes:
+    """ Awaitable hash_password running on an executor """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or get_executor(),
+                                      hash_password, password)
+
+
+async def is_valid_async(hashed_password: bytes, password: str,
+                         executor: Executor = None) -> bool:
+    """ Awaitable is_valid running on an executor """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor or get_executor(),
+                                      is_valid, hashed_password, password)
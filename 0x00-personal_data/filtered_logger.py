@@ -2,13 +2,146 @@
 """
 Module for handling Personal Data
 """
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Mapping, Sequence, \
+    Tuple, Union
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import re
 import logging
+import logging.handlers
+import atexit
+import copy
+import hashlib
+import hmac
+import json
 import os
+import queue
+import sys
+import threading
+import time
 import mysql.connector
 
 PII_FIELDS = ("name", "email", "phone", "ssn", "password")
+OVERFLOW_POLICIES = ("block", "drop-oldest", "count-and-drop")
+EXPORT_BATCH_SIZE = 1000
+# value types rendered as text in the messages, whatever the column type
+TEXTUAL_TYPES = (str, bytes, bytearray, set, frozenset)
+
+_pipeline_lock = threading.Lock()
+_listener = None
+# options of the installed pipeline, None when get_logger didn't install it
+_pipeline_options = None
+_worker_formatter = None
+_pool = None
+_pool_lock = threading.Lock()
+# attributes of every LogRecord, the other ones come from `extra`
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", logging.INFO, "", 0, "", None, None).__dict__) | \
+    {"message", "asctime", "redacted"}
+
+
+class Redactor:
+    """Single-pass redaction engine
+
+    Compiles a field list and a separator into one alternation pattern so
+    a log line is scanned once, whatever the number of fields.
+    """
+
+    def __init__(self, fields: Tuple[str, ...], redaction: str,
+                 separator: str, line_bound: bool = False):
+        """Initialize the engine
+
+        Args:
+            fields (Tuple[str, ...]): fields to redact
+            redaction (str): replacement for the field values
+            separator (str): character separating the fields
+            line_bound (bool): values also end at a line ending, CR or
+                               LF, for text holding several log lines
+        """
+        self.fields = tuple(fields)
+        self.redaction = redaction
+        self.separator = separator
+        self.pattern = None
+        if self.fields:
+            # longest first so overlapping names keep the widest match
+            names = sorted(set(self.fields), key=len, reverse=True)
+            alternation = "|".join(re.escape(name) for name in names)
+            stop = re.escape(separator) + (r'\r\n' if line_bound else '')
+            self.pattern = re.compile(
+                f'(?P<field>{alternation})=(?P<value>[^{stop}]*)')
+        self.template = r'\g<field>=' + redaction.replace('\\', '\\\\')
+
+    def redact(self, message: str) -> str:
+        """Returns the message with every field value redacted"""
+        if self.pattern is None:
+            return message
+        return self.pattern.sub(self.template, message)
+
+    def replace(self, message: str, replacement: Callable[[str], str]) -> str:
+        """Returns the message with every field value mapped by replacement
+        """
+        if self.pattern is None:
+            return message
+        return self.pattern.sub(
+            lambda match: "{}={}".format(match.group("field"),
+                                         replacement(match.group("value"))),
+            message)
+
+
+class Pseudonymizer:
+    """ Keyed HMAC-SHA256 pseudonyms of field values
+
+    The same value always gets the same pseudonym for a given key, so
+    events of one user can be correlated without logging the value.
+    Pseudonyms are memoized in a bounded LRU cache whose statistics are
+    returned by stats().
+    """
+
+    def __init__(self, key: bytes, maxsize: int = 4096, length: int = 16):
+        """Initialize the pseudonymizer
+
+        Args:
+            key (bytes): the HMAC secret key
+            maxsize (int): number of memoized values
+            length (int): number of hex digits kept from the digest
+        """
+        self.key = key
+        self.length = length
+        self._pseudonym = lru_cache(maxsize=maxsize)(self._digest)
+
+    def _digest(self, value: str) -> str:
+        """Returns the pseudonym of a value, uncached"""
+        digest = hmac.new(self.key, value.encode(), hashlib.sha256)
+        return digest.hexdigest()[:self.length]
+
+    def __call__(self, value: str) -> str:
+        """Returns the pseudonym of a value"""
+        return self._pseudonym(value)
+
+    def stats(self) -> dict:
+        """Returns hits, misses, size, maxsize and hit_ratio of the memo"""
+        info = self._pseudonym.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "maxsize": info.maxsize,
+            "hit_ratio": info.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """Empties the memo and resets its statistics"""
+        self._pseudonym.cache_clear()
+
+
+@lru_cache(maxsize=128)
+def get_redactor(fields: Tuple[str, ...], redaction: str,
+                 separator: str, line_bound: bool = False) -> Redactor:
+    """Returns the compiled Redactor for a (fields, separator, redaction) key
+    """
+    return Redactor(fields, redaction, separator, line_bound)
 
 
 def filter_datum(fields: List[str], redaction: str, message: str,
@@ -25,29 +158,35 @@ def filter_datum(fields: List[str], redaction: str, message: str,
     Returns:
         str: The obfuscated log message
     """
-    for field in fields:
-        message = re.sub(f'{field}=[^{separator}]*', f'{field}={redaction}',
-                         message)
-    return message
+    return get_redactor(tuple(fields), redaction, separator).redact(message)
 
 
 class RedactingFormatter(logging.Formatter):
     """ Redacting Formatter class
 
     This class redacts sensitive information from log messages.
+    Records flagged with a true `redacted` attribute were already
+    redacted at the source and are formatted without the regex pass.
+    With a pseudonymizer, values are replaced by their pseudonym instead
+    of REDACTION.
     """
     REDACTION = "***"
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str],
+                 pseudonymizer: Pseudonymizer = None):
         """Initialize the formatter
 
         Args:
             fields (List[str]): list of fields to redact
+            pseudonymizer (Pseudonymizer): pseudonymization strategy
         """
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.pseudonymizer = pseudonymizer
+        self.redactor = get_redactor(tuple(fields), self.REDACTION,
+                                     self.SEPARATOR)
 
     def format(self, record: logging.LogRecord) -> str:
         """Format the log record
@@ -59,58 +198,746 @@ class RedactingFormatter(logging.Formatter):
             str: the formatted and redacted log message
         """
         message = super().format(record)
-        return filter_datum(self.fields, self.REDACTION, message,
-                            self.SEPARATOR)
+        if getattr(record, "redacted", False):
+            return message
+        if self.pseudonymizer is not None:
+            return self.redactor.replace(message, self.pseudonymizer)
+        return self.redactor.redact(message)
+
+
+class StructuredRedactingFormatter(logging.Formatter):
+    """ Structured Redacting Formatter class
+
+    Formats records as JSON lines. Mappings logged as the message or
+    passed through `extra` are redacted by key lookup against a frozen
+    set of fields, nested mappings, lists and tuples included; plain
+    string messages and the other string values still go through the
+    regex redactor. With a pseudonymizer, values are replaced by their
+    pseudonym instead of REDACTION.
+    """
+    REDACTION = RedactingFormatter.REDACTION
+    SEPARATOR = RedactingFormatter.SEPARATOR
+
+    def __init__(self, fields: List[str],
+                 pseudonymizer: Pseudonymizer = None):
+        """Initialize the formatter
+
+        Args:
+            fields (List[str]): list of fields to redact
+            pseudonymizer (Pseudonymizer): pseudonymization strategy
+        """
+        super(StructuredRedactingFormatter, self).__init__()
+        self.fields = frozenset(fields)
+        self.pseudonymizer = pseudonymizer
+        self.redactor = get_redactor(tuple(fields), self.REDACTION,
+                                     self.SEPARATOR)
+
+    def redact(self, data: Mapping) -> dict:
+        """Returns a copy of data with the values of the fields redacted
+
+        Args:
+            data (Mapping): the structured log data
+
+        Returns:
+            dict: the redacted data
+        """
+        fields = self.fields
+        redacted = {}
+        for key, value in data.items():
+            if key in fields:
+                if self.pseudonymizer is not None:
+                    redacted[key] = self.pseudonymizer(str(value))
+                else:
+                    redacted[key] = self.REDACTION
+            else:
+                redacted[key] = self._redact_value(value)
+        return redacted
+
+    def _redact_value(self, value):
+        """Returns a value of a field not to redact, with the fields of
+        its mappings and the field values of its strings redacted"""
+        if isinstance(value, Mapping):
+            return self.redact(value)
+        if isinstance(value, (list, tuple)):
+            return [self._redact_value(item) for item in value]
+        if isinstance(value, str):
+            return self._redact_text(value)
+        return value
+
+    def _redact_text(self, text: str) -> str:
+        """Returns text with the field values redacted by the regex"""
+        if self.pseudonymizer is not None:
+            return self.redactor.replace(text, self.pseudonymizer)
+        return self.redactor.redact(text)
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format the log record
+
+        Args:
+            record (logging.LogRecord): the log record
+
+        Returns:
+            str: the redacted record as a JSON object
+        """
+        payload = {
+            "name": record.name,
+            "level": record.levelname,
+            "time": self.formatTime(record),
+        }
+        if isinstance(record.msg, Mapping):
+            payload.update(self.redact(record.msg))
+        else:
+            message = record.getMessage()
+            if not getattr(record, "redacted", False):
+                message = self._redact_text(message)
+            payload["message"] = message
+        extra = {key: value for key, value in record.__dict__.items()
+                 if key not in _RECORD_ATTRIBUTES}
+        if extra:
+            payload.update(self.redact(extra))
+        if record.exc_info:
+            payload["exc_info"] = self.redactor.redact(
+                self.formatException(record.exc_info))
+        return json.dumps(payload, default=str)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler for a bounded queue
+
+    Applies an overflow policy when the queue is full:
+      - block: wait for the listener to free a slot
+      - drop-oldest: discard the oldest queued record
+      - count-and-drop: discard the new record
+    Discarded records are counted in `dropped`.
+    """
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = "block"):
+        """Initialize the handler
+
+        Args:
+            log_queue (queue.Queue): queue shared with the listener
+            overflow (str): one of OVERFLOW_POLICIES
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        super(BoundedQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
 
+    def _count_drop(self):
+        """Counts one discarded record"""
+        with self._dropped_lock:
+            self.dropped += 1
 
-def get_logger() -> logging.Logger:
+    def enqueue(self, record: logging.LogRecord):
+        """Enqueue a record according to the overflow policy
+
+        Args:
+            record (logging.LogRecord): the prepared log record
+        """
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                if self.overflow == "count-and-drop":
+                    self._count_drop()
+                    return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self._count_drop()
+            except queue.Empty:
+                pass
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Prepare a record for the queue, keeping mapping messages intact
+        for StructuredRedactingFormatter
+        """
+        if isinstance(record.msg, Mapping) and not record.args:
+            return copy.copy(record)
+        return super(BoundedQueueHandler, self).prepare(record)
+
+
+class RedactingListener(logging.handlers.QueueListener):
+    """ Queue listener doing the redaction and writing off the caller thread
+    """
+
+    def enqueue_sentinel(self):
+        """Wait for a free slot so a full queue is drained on stop"""
+        self.queue.put(self._sentinel)
+
+
+def get_logger(queued: bool = False, queue_size: int = 10000,
+               overflow: str = "block", structured: bool = False,
+               pseudonymizer: Pseudonymizer = None) -> logging.Logger:
     """Returns a Logger object
 
+    The pipeline is installed once: later calls with the same options
+    return the same logger without adding handlers. Calls with other
+    options raise ValueError until shutdown_logger() removes it.
+
+    Args:
+        queued (bool): redact and write from a background listener thread
+        queue_size (int): maximum number of pending records when queued
+        overflow (str): policy applied when the queue is full, one of
+                        OVERFLOW_POLICIES
+        structured (bool): write JSON lines with
+                           StructuredRedactingFormatter
+        pseudonymizer (Pseudonymizer): log pseudonyms of the PII values
+                                       instead of REDACTION
+
     Returns:
         logging.Logger: Configured logger
     """
+    global _listener, _pipeline_options
     logger = logging.getLogger("user_data")
-    logger.setLevel(logging.INFO)
-    logger.propagate = False
+    options = (queued, queue_size, overflow, structured, pseudonymizer)
+    with _pipeline_lock:
+        if logger.handlers:
+            if _pipeline_options not in (None, options):
+                raise ValueError("The logger pipeline is already installed"
+                                 " with other options, call "
+                                 "shutdown_logger() first")
+            return logger
+        _pipeline_options = options
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setFormatter(RedactingFormatter(list(PII_FIELDS)))
-    logger.addHandler(stream_handler)
+        formatter_class = StructuredRedactingFormatter if structured \
+            else RedactingFormatter
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter_class(list(PII_FIELDS),
+                                                    pseudonymizer))
+        if not queued:
+            logger.addHandler(stream_handler)
+            return logger
 
-    return logger
+        log_queue = queue.Queue(maxsize=queue_size)
+        queue_handler = BoundedQueueHandler(log_queue, overflow)
+        _listener = RedactingListener(log_queue, stream_handler,
+                                      respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(queue_handler)
 
+    return logger
 
-def get_db() -> mysql.connector.connection.MySQLConnection:
-    """Returns a connector to a MySQL database
 
-    Returns:
-        mysql.connector.connection.MySQLConnection: database connection
+@atexit.register
+def shutdown_logger():
+    """Flushes pending records and removes the logger pipeline
     """
-    db_connect = mysql.connector.connect(
+    global _listener, _pipeline_options
+    logger = logging.getLogger("user_data")
+    with _pipeline_lock:
+        _pipeline_options = None
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.flush()
+            _listener = None
+        for handler in list(logger.handlers):
+            handler.flush()
+            logger.removeHandler(handler)
+
+
+def _db_config() -> dict:
+    """Returns the connection settings read from the environment"""
+    return dict(
         user=os.getenv("PERSONAL_DATA_DB_USERNAME", "root"),
         password=os.getenv("PERSONAL_DATA_DB_PASSWORD", ""),
         host=os.getenv("PERSONAL_DATA_DB_HOST", "localhost"),
         database=os.getenv("PERSONAL_DATA_DB_NAME"),
     )
+
+
+class PooledConnection:
+    """ Connection checked out of a ConnectionPool
+
+    Attributes are delegated to the MySQL connection, and close() hands
+    the connection back to the pool instead of closing it. Leaving a
+    with block, or dropping the wrapper, closes it too.
+    """
+
+    def __init__(self, pool: "ConnectionPool",
+                 cnx: mysql.connector.connection.MySQLConnection):
+        """Initialize the wrapper
+
+        Args:
+            pool (ConnectionPool): the pool owning the connection
+            cnx (MySQLConnection): the wrapped connection
+        """
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, attr: str):
+        """Delegates to the wrapped connection"""
+        if attr in ("_pool", "_cnx"):
+            raise AttributeError(attr)
+        return getattr(self._cnx, attr)
+
+    def __enter__(self) -> "PooledConnection":
+        """Returns the connection for a with block"""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Returns the connection to the pool at the end of the block"""
+        self.close()
+
+    def __del__(self):
+        """Returns a connection dropped without close() to the pool"""
+        if getattr(self, "_cnx", None) is not None:
+            self.close()
+
+    def close(self):
+        """Returns the connection to the pool"""
+        cnx, self._cnx = self._cnx, None
+        if cnx is not None:
+            self._pool.release(cnx)
+
+
+class ConnectionPool:
+    """ Pool of MySQL connections
+
+    At most `size` connections are checked out at once, get_connection
+    waits up to `timeout` seconds when they all are. Idle connections
+    are reused most recently released first, and are validated on
+    checkout; the ones idle for more than `idle_timeout` seconds are
+    closed.
+    """
+
+    def __init__(self, size: int, idle_timeout: float = 300,
+                 timeout: float = 30, **config):
+        """Initialize the pool
+
+        Args:
+            size (int): maximum number of connections
+            idle_timeout (float): seconds an idle connection is kept
+            timeout (float): seconds get_connection waits for a free
+                             connection, None to wait forever
+            config: arguments of mysql.connector.connect
+        """
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.config = config
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @staticmethod
+    def _discard(cnx: mysql.connector.connection.MySQLConnection):
+        """Closes a connection leaving the pool"""
+        try:
+            cnx.close()
+        except mysql.connector.Error:
+            pass
+
+    def _evict_expired(self, now: float):
+        """Closes the connections idle for longer than idle_timeout"""
+        expired = []
+        with self._lock:
+            while self._idle and now - self._idle[0][1] > self.idle_timeout:
+                expired.append(self._idle.popleft()[0])
+        for cnx in expired:
+            self._discard(cnx)
+
+    def _checkout_idle(self) -> mysql.connector.connection.MySQLConnection:
+        """Returns a live idle connection, or None"""
+        self._evict_expired(time.monotonic())
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                cnx, _ = self._idle.pop()
+            try:
+                if cnx.is_connected():
+                    return cnx
+            except mysql.connector.Error:
+                pass
+            self._discard(cnx)
+
+    def get_connection(self) -> PooledConnection:
+        """Returns a connection checked out of the pool
+
+        Returns:
+            PooledConnection: connection to close once done with it
+
+        Raises:
+            mysql.connector.errors.PoolError: no connection was released
+                                              within `timeout` seconds
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise mysql.connector.errors.PoolError(
+                "Failed getting connection; pool exhausted")
+        try:
+            cnx = self._checkout_idle()
+            if cnx is None:
+                cnx = mysql.connector.connect(**self.config)
+        except Exception:
+            self._slots.release()
+            raise
+        return PooledConnection(self, cnx)
+
+    def release(self, cnx: mysql.connector.connection.MySQLConnection):
+        """Puts a connection back into the pool
+
+        Pending transactions are rolled back, and connections that can't
+        be reset are closed instead.
+        """
+        try:
+            try:
+                cnx.rollback()
+            except mysql.connector.Error:
+                self._discard(cnx)
+                return
+            with self._lock:
+                self._idle.append((cnx, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for cnx, _ in idle:
+            self._discard(cnx)
+
+
+def get_pool() -> ConnectionPool:
+    """Returns the module connection pool
+
+    Its size, idle timeout and checkout timeout are read from the
+    PERSONAL_DATA_DB_POOL_SIZE, PERSONAL_DATA_DB_POOL_IDLE_TIMEOUT and
+    PERSONAL_DATA_DB_POOL_TIMEOUT environment variables.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", 5)),
+                float(os.getenv("PERSONAL_DATA_DB_POOL_IDLE_TIMEOUT", 300)),
+                float(os.getenv("PERSONAL_DATA_DB_POOL_TIMEOUT", 30)),
+                **_db_config())
+        return _pool
+
+
+def get_db() -> Union[mysql.connector.connection.MySQLConnection,
+                      PooledConnection]:
+    """Returns a connector to a MySQL database
+
+    When PERSONAL_DATA_DB_POOL_SIZE is set, the connection comes from the
+    pool and closing it returns it there.
+
+    Returns:
+        Union[MySQLConnection, PooledConnection]: database connection, a
+                                                  PooledConnection when
+                                                  pooled
+    """
+    if int(os.getenv("PERSONAL_DATA_DB_POOL_SIZE", 0)) > 0:
+        return get_pool().get_connection()
+    db_connect = mysql.connector.connect(**_db_config())
     return db_connect
 
 
-def main():
+def row_template(column_names: Sequence[str]) -> str:
+    """Returns a str.format template rendering a row as key=value pairs
+
+    Args:
+        column_names (Sequence[str]): the columns of the result set
+
+    Returns:
+        str: template such as "name={}; email={}"
+    """
+    escaped = (name.replace("{", "{{").replace("}", "}}")
+               for name in column_names)
+    return "; ".join(f"{name}={{}}" for name in escaped)
+
+
+def quote_identifier(name: str) -> str:
+    """Returns a MySQL identifier quoted with backticks"""
+    return "`{}`".format(name.replace("`", "``"))
+
+
+def _to_str(value) -> str:
+    """Returns a value read from information_schema as a str"""
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    return value
+
+
+def table_columns(db: mysql.connector.connection.MySQLConnection,
+                  table: str) -> List[Tuple[str, str]]:
+    """Returns the columns of a table of the current database
+
+    Args:
+        db (MySQLConnection): database connection
+        table (str): the table name
+
+    Returns:
+        List[Tuple[str, str]]: (column name, data type) pairs in order
+    """
+    cursor = db.cursor()
+    try:
+        cursor.execute(
+            "SELECT COLUMN_NAME, DATA_TYPE FROM information_schema.COLUMNS"
+            " WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+            " ORDER BY ORDINAL_POSITION;", (table,))
+        return [(_to_str(name), _to_str(data_type).lower())
+                for name, data_type in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def is_pii_column(column: str, fields: Sequence[str]) -> bool:
+    """Returns True if filter_datum would redact the column's value
+
+    The redaction pattern matches `field=` anywhere, so a column is
+    redacted when its name ends with one of the fields.
+    """
+    return any(column.endswith(field) for field in fields)
+
+
+def build_redacted_select(table: str, columns: List[Tuple[str, str]],
+                          fields: Sequence[str],
+                          redaction: str) -> Tuple[str, tuple]:
+    """Returns a SELECT replacing the PII columns by the redaction literal
+
+    Args:
+        table (str): the table name
+        columns (List[Tuple[str, str]]): columns as returned by table_columns
+        fields (Sequence[str]): the PII fields
+        redaction (str): the redaction literal
+
+    Returns:
+        Tuple[str, tuple]: the query and its parameters
+    """
+    selected = []
+    params = []
+    for name, _ in columns:
+        if is_pii_column(name, fields):
+            selected.append("%s AS {}".format(quote_identifier(name)))
+            params.append(redaction)
+        else:
+            selected.append(quote_identifier(name))
+    query = "SELECT {} FROM {};".format(", ".join(selected),
+                                        quote_identifier(table))
+    return query, tuple(params)
+
+
+def iter_user_batches(db: mysql.connector.connection.MySQLConnection,
+                      batch_size: int = EXPORT_BATCH_SIZE,
+                      query: str = "SELECT * FROM users;",
+                      params: tuple = (),
+                      transform: Callable[[tuple], tuple] = None
+                      ) -> Iterator[List[str]]:
+    """Yields the rows of the users table as batches of log messages
+
+    Rows are streamed from an unbuffered cursor with fetchmany, so memory
+    is bounded by batch_size whatever the size of the table.
+
+    Args:
+        db (MySQLConnection): database connection
+        batch_size (int): number of rows fetched per round trip
+        query (str): the SELECT to run
+        params (tuple): the query parameters
+        transform (Callable): optional function applied to each row
+
+    Returns:
+        Iterator[List[str]]: one list of messages per batch
+    """
+    cursor = db.cursor(buffered=False)
+    try:
+        cursor.execute(query, params)
+        template = row_template(cursor.column_names)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if transform is not None:
+                rows = map(transform, rows)
+            yield [template.format(*row) for row in rows]
+    finally:
+        cursor.close()
+
+
+def iter_redacted_user_batches(
+        db: mysql.connector.connection.MySQLConnection,
+        batch_size: int = EXPORT_BATCH_SIZE,
+        fields: Sequence[str] = PII_FIELDS,
+        columns: List[Tuple[str, str]] = None,
+        redact_free_text: bool = True) -> Iterator[List[str]]:
+    """Yields batches of users messages redacted by the MySQL server
+
+    PII columns are replaced by the redaction literal in the SELECT, so
+    their values are never sent to the client. Every other value read as
+    text (str, bytes or set, whatever the column type: char, json, enum,
+    blob...) still goes through the regex redactor, since it may embed
+    `field=value` pairs.
+
+    Args:
+        db (MySQLConnection): database connection
+        batch_size (int): number of rows fetched per round trip
+        fields (Sequence[str]): the PII fields
+        columns (List[Tuple[str, str]]): the users columns, introspected
+                                         when not given
+        redact_free_text (bool): redact the text values, disable it when
+                                 the lines are redacted afterwards
+
+    Returns:
+        Iterator[List[str]]: one list of already redacted messages per batch
+    """
+    redaction = RedactingFormatter.REDACTION
+    if columns is None:
+        columns = table_columns(db, "users")
+    query, params = build_redacted_select("users", columns, fields,
+                                          redaction)
+    free_text = [index for index, (name, _) in enumerate(columns)
+                 if not is_pii_column(name, fields)]
+    transform = None
+    if free_text and redact_free_text:
+        redactor = get_redactor(tuple(fields), redaction,
+                                RedactingFormatter.SEPARATOR)
+
+        def transform(row: tuple) -> tuple:
+            """Redacts the text values of a row, as the message shows them"""
+            row = list(row)
+            for index in free_text:
+                value = row[index]
+                if isinstance(value, str):
+                    row[index] = redactor.redact(value)
+                elif isinstance(value, TEXTUAL_TYPES):
+                    row[index] = redactor.redact("{}".format(value))
+            return row
+
+    return iter_user_batches(db, batch_size, query, params, transform)
+
+
+def log_batch(logger: logging.Logger, messages: List[str],
+              level: int = logging.INFO, redacted: bool = False):
+    """Logs a batch of messages
+
+    Stream handlers receive the whole formatted batch in a single write
+    and flush, other handlers get the records one by one.
+
+    Args:
+        logger (logging.Logger): the logger
+        messages (List[str]): the messages to log
+        level (int): the logging level
+        redacted (bool): the messages are already redacted
+    """
+    if not logger.isEnabledFor(level):
+        return
+    extra = {"redacted": True} if redacted else None
+    records = [logger.makeRecord(logger.name, level, __file__, 0, message,
+                                 None, None, extra=extra)
+               for message in messages]
+    for handler in logger.handlers:
+        if level < handler.level:
+            continue
+        if not isinstance(handler, logging.StreamHandler) or \
+                handler.stream is None:
+            for record in records:
+                handler.handle(record)
+            continue
+        lines = "".join(handler.format(record) + handler.terminator
+                        for record in records if handler.filter(record))
+        with handler.lock:
+            handler.stream.write(lines)
+            handler.flush()
+
+
+def _init_worker(fields: Tuple[str, ...]):
+    """Builds the RedactingFormatter of a redaction worker process"""
+    global _worker_formatter
+    _worker_formatter = RedactingFormatter(list(fields))
+
+
+def _format_batch(messages: List[str]) -> str:
+    """Returns a batch of messages formatted and redacted by the worker"""
+    lines = []
+    for message in messages:
+        record = logging.LogRecord("user_data", logging.INFO, __file__, 0,
+                                   message, None, None)
+        lines.append(_worker_formatter.format(record) + "\n")
+    return "".join(lines)
+
+
+def export_parallel(batches: Iterable[List[str]], workers: int,
+                    stream=None, fields: Sequence[str] = PII_FIELDS):
+    """Formats and redacts batches in a process pool
+
+    At most two batches per worker are in flight, and results are written
+    by the calling process in the order of the batches.
+
+    Args:
+        batches (Iterable[List[str]]): batches of messages
+        workers (int): number of worker processes
+        stream: where the lines are written, sys.stderr by default
+        fields (Sequence[str]): the PII fields
+    """
+    if stream is None:
+        stream = sys.stderr
+    pending = deque()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(tuple(fields),)) as executor:
+        for messages in batches:
+            pending.append(executor.submit(_format_batch, messages))
+            if len(pending) >= workers * 2:
+                stream.write(pending.popleft().result())
+        while pending:
+            stream.write(pending.popleft().result())
+    stream.flush()
+
+
+def main(batch_size: int = None, workers: int = None):
     """
     Obtain a database connection using get_db and retrieve all rows
     in the users table, displaying each row in a filtered format
-    """
-    db = get_db()
-    cursor = db.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users;")
-    logger = get_logger()
 
-    for row in cursor:
-        message = "; ".join([f"{key}={value}" for key, value in row.items()])
-        logger.info(message)
+    PII columns are redacted by the SELECT itself; the regex redactor is
+    used when the table columns can't be introspected.
 
-    cursor.close()
-    db.close()
+    Args:
+        batch_size (int): rows per batch, defaults to the
+                          PERSONAL_DATA_EXPORT_BATCH_SIZE environment
+                          variable or EXPORT_BATCH_SIZE
+        workers (int): redaction processes, defaults to the
+                       PERSONAL_DATA_EXPORT_WORKERS environment variable
+                       or 1; with more than one, batches are formatted by
+                       export_parallel and written to stderr
+    """
+    if batch_size is None:
+        batch_size = int(os.getenv("PERSONAL_DATA_EXPORT_BATCH_SIZE",
+                                   EXPORT_BATCH_SIZE))
+    if workers is None:
+        workers = int(os.getenv("PERSONAL_DATA_EXPORT_WORKERS", 1))
+    db = get_db()
+    try:
+        columns = table_columns(db, "users")
+        if workers > 1:
+            if columns:
+                batches = iter_redacted_user_batches(
+                    db, batch_size, columns=columns, redact_free_text=False)
+            else:
+                batches = iter_user_batches(db, batch_size)
+            export_parallel(batches, workers)
+            return
+        logger = get_logger()
+        if columns:
+            batches = iter_redacted_user_batches(db, batch_size,
+                                                 columns=columns)
+            for messages in batches:
+                log_batch(logger, messages, redacted=True)
+        else:
+            for messages in iter_user_batches(db, batch_size):
+                log_batch(logger, messages)
+    finally:
+        db.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Module redacting existing log files
+
+Usage: ./redact_logs.py [-f FIELD ...] [-r REDACTION] [-s SEPARATOR]
+                        [-o OUTPUT] [--chunk-size BYTES] path
+"""
+from typing import BinaryIO, Iterator, Sequence
+import argparse
+import mmap
+import os
+import shutil
+import tempfile
+
+from filtered_logger import PII_FIELDS, RedactingFormatter, get_redactor
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def iter_line_chunks(buffer: mmap.mmap,
+                     chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Yields chunks of a buffer cut on line boundaries
+
+    Args:
+        buffer (mmap.mmap): the mapped file
+        chunk_size (int): target size of a chunk, a line longer than it
+                          makes a chunk of its own
+
+    Returns:
+        Iterator[bytes]: chunks holding whole lines
+    """
+    size = len(buffer)
+    start = 0
+    while start < size:
+        end = min(start + chunk_size, size)
+        if end < size:
+            newline = buffer.rfind(b"\n", start, end)
+            if newline == -1:
+                newline = buffer.find(b"\n", end)
+            end = size if newline == -1 else newline + 1
+        yield buffer[start:end]
+        start = end
+
+
+def redact_stream(source: BinaryIO, target: BinaryIO,
+                  fields: Sequence[str] = PII_FIELDS,
+                  redaction: str = RedactingFormatter.REDACTION,
+                  separator: str = RedactingFormatter.SEPARATOR,
+                  chunk_size: int = CHUNK_SIZE):
+    """Writes the redacted content of a log file to target
+
+    The source is memory-mapped and redacted chunk by chunk, so memory
+    use doesn't depend on the file size. Fields are matched as in
+    filter_datum, each value ending at the separator or at a line
+    ending, CR or LF.
+
+    Args:
+        source (BinaryIO): the log file, opened for reading
+        target (BinaryIO): where the redacted lines are written
+        fields (Sequence[str]): fields to redact
+        redaction (str): replacement for the field values
+        separator (str): character separating the fields
+        chunk_size (int): bytes redacted at a time
+    """
+    if os.fstat(source.fileno()).st_size == 0:
+        return
+    redactor = get_redactor(tuple(fields), redaction, separator, True)
+    with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        if hasattr(buffer, "madvise"):
+            buffer.madvise(mmap.MADV_SEQUENTIAL)
+        for chunk in iter_line_chunks(buffer, chunk_size):
+            text = chunk.decode("utf-8", "surrogateescape")
+            target.write(
+                redactor.redact(text).encode("utf-8", "surrogateescape"))
+
+
+def redact_file(path: str, output: str = None,
+                fields: Sequence[str] = PII_FIELDS,
+                redaction: str = RedactingFormatter.REDACTION,
+                separator: str = RedactingFormatter.SEPARATOR,
+                chunk_size: int = CHUNK_SIZE):
+    """Redacts a log file in place or into output
+
+    In place, the redacted copy is written next to the file then renamed
+    over it, so the file is never left half redacted.
+
+    Args:
+        path (str): the log file
+        output (str): the redacted file, path itself when None
+        fields (Sequence[str]): fields to redact
+        redaction (str): replacement for the field values
+        separator (str): character separating the fields
+        chunk_size (int): bytes redacted at a time
+    """
+    in_place = output is None or os.path.abspath(output) == \
+        os.path.abspath(path)
+    if not in_place:
+        with open(path, 'rb') as source, open(output, 'wb') as target:
+            redact_stream(source, target, fields, redaction, separator,
+                          chunk_size)
+        return
+
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".{}.".format(name),
+                                    dir=directory)
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+            redact_stream(source, target, fields, redaction, separator,
+                          chunk_size)
+            target.flush()
+            os.fsync(target.fileno())
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def main():
+    """Parses the command line and redacts the file"""
+    parser = argparse.ArgumentParser(
+        description="Redact PII fields of a key=value; log file")
+    parser.add_argument("path", help="log file to redact")
+    parser.add_argument("-o", "--output",
+                        help="write the redacted file there instead of "
+                             "redacting in place")
+    parser.add_argument("-f", "--field", action="append", dest="fields",
+                        help="field to redact, repeatable "
+                             "(default: PII_FIELDS)")
+    parser.add_argument("-r", "--redaction",
+                        default=RedactingFormatter.REDACTION)
+    parser.add_argument("-s", "--separator",
+                        default=RedactingFormatter.SEPARATOR)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+    redact_file(args.path, args.output, args.fields or PII_FIELDS,
+                args.redaction, args.separator, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,124 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
+from typing import Iterable, Iterator, List, Optional
+from urllib.parse import urlencode
+import copy
+import hashlib
+import json
 from models.user import User
 
+DEFAULT_PAGE_SIZE = 100
+STREAM_CHUNK_SIZE = 100
+FILTERS = ('email', 'first_name', 'last_name')
+
+
+def stream_json_array(items: Iterable[dict]) -> Iterator[str]:
+    """ Yield the JSON array of items by chunks of STREAM_CHUNK_SIZE
+    """
+    chunk = []
+    separator = "["
+    for item in items:
+        chunk.append(separator + json.dumps(item))
+        separator = ","
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]" if separator == "," else "[]")
+    yield "".join(chunk)
+
+
+def requested_fields() -> Optional[List[str]]:
+    """ Return the attributes of the `fields` query parameter, None when
+    all attributes are requested
+    """
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    return [field for field in fields.split(',') if field]
+
+
+def response_etag(tag: str) -> str:
+    """ Return the quoted ETag of the response to the current request
+    for data whose entity tag is tag
+    """
+    digest = hashlib.sha1(tag.encode() + b"?" + request.query_string)
+    return '"{}"'.format(digest.hexdigest())
+
+
+def not_modified(etag: str) -> bool:
+    """ Whether the If-None-Match header of the request matches etag
+    """
+    return request.if_none_match.contains_weak(etag.strip('"'))
+
+
+def project(item: dict, fields: Optional[List[str]]) -> dict:
+    """ Keep the requested fields of a JSON dictionary
+    """
+    if fields is None:
+        return item
+    return {field: item[field] for field in fields if field in item}
+
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters:
+      - email, first_name, last_name (optional): only the users with
+        these values
+      - fields (optional): comma separated attributes to return
+      - limit (optional): number of users per page, users being ordered
+        by creation date
+      - after (optional): cursor of the page, given by the `next` link
+        of the previous page (Link header)
+      - stream (optional): 1 to stream the JSON array
     Return:
-      - list of all User objects JSON represented
+      - list of User objects JSON represented
+      - 304 if If-None-Match has the ETag of the list, unchanged
+      - 400 if limit or after is invalid
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    etag = response_etag(User.class_etag())
+    if not_modified(etag):
+        return '', 304, {'ETag': etag}
+    filters = {attr: request.args[attr] for attr in FILTERS
+               if attr in request.args}
+    fields = requested_fields()
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    headers = {'ETag': etag}
+    if limit is None and after is None:
+        users = User.search(filters) if filters else None
+    else:
+        try:
+            limit = DEFAULT_PAGE_SIZE if limit is None else int(limit)
+        except ValueError:
+            return jsonify({'error': "Invalid limit"}), 400
+        try:
+            users, next_cursor = User.page(limit, after, filters)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if next_cursor is not None:
+            args = request.args.to_dict()
+            args.update(limit=limit, after=next_cursor)
+            headers['Link'] = '<{}?{}>; rel="next"'.format(
+                request.base_url, urlencode(args))
+
+    stream = request.args.get('stream') == '1'
+    if users is not None:
+        items = (user.to_json() for user in users)
+    elif stream:
+        items = User.iter_json()
+    else:
+        items = User.to_json_list()
+    if fields is not None:
+        items = (project(item, fields) for item in items)
+    if stream:
+        return Response(stream_json_array(items),
+                        mimetype='application/json', headers=headers)
+    if type(items) is not list:
+        items = list(items)
+    return jsonify(items), 200, headers
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
@@ -21,8 +127,11 @@ def view_one_user(user_id: str = None) -> str:
     """ GET /api/v1/users/:id
     Path parameter:
       - User ID
+    Query parameter:
+      - fields (optional): comma separated attributes to return
     Return:
       - User object JSON represented
+      - 304 if If-None-Match has the ETag of the user, unchanged
       - 404 if the User ID doesn't exist
     """
     if user_id is None:
@@ -30,7 +139,11 @@ def view_one_user(user_id: str = None) -> str:
     user = User.get(user_id)
     if user is None:
         abort(404)
-    return jsonify(user.to_json())
+    etag = response_etag(user.etag())
+    if not_modified(etag):
+        return '', 304, {'ETag': etag}
+    return jsonify(project(user.to_json(), requested_fields())), 200, \
+        {'ETag': etag}
 
 
 @app_views.route('/users/<user_id>', methods=['DELETE'], strict_slashes=False)
@@ -114,6 +227,9 @@ def update_user(user_id: str = None) -> str:
         rj = None
     if rj is None:
         return jsonify({'error': "Wrong format"}), 400
+    # the loaded user is shared with the other requests: change a copy,
+    # which replaces it once saved
+    user = copy.copy(user)
     if rj.get('first_name') is not None:
         user.first_name = rj.get('first_name')
     if rj.get('last_name') is not None:
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+""" Query module
+"""
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple, TypeVar
+import bisect
+import heapq
+import itertools
+import operator
+
+
+def _prefix(value, prefix: str) -> bool:
+    """ Whether value is a string starting with prefix
+    """
+    return type(value) is str and value.startswith(prefix)
+
+
+def _in(value, values) -> bool:
+    """ Whether value is one of values
+    """
+    return value in values
+
+
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "prefix": _prefix,
+    "in": _in,
+}
+# operators an index of the attribute can answer
+INDEX_OPERATORS = ("eq", "in", "prefix")
+# attribute whose sorted (created_at, id) keys the model keeps
+ORDER_ATTRIBUTE = "created_at"
+
+
+def _sort_value(value) -> tuple:
+    """ Return the sort key of an attribute value, None after any value
+    """
+    return (value is None, value)
+
+
+class Query():
+    """ Lazy query over the objects of a model class
+
+    Conditions are keyword arguments, `attr=value` for equality or
+    `attr__op=value` with op one of OPERATORS. A query is immutable:
+    filter, order_by, limit and offset return a new one. Objects are
+    read when the query is iterated; without ordering, or ordered by
+    creation date, iteration stops as soon as the limit is reached.
+
+    The plan reads the candidates from the smallest matching index
+    bucket, or walks the creation date order when the query is ordered
+    or filtered by creation date and that's cheaper, or scans all
+    objects.
+    """
+
+    def __init__(self, cls: type, conditions: Tuple[tuple, ...] = (),
+                 ordering: Tuple[Tuple[str, bool], ...] = (),
+                 limit: int = None, offset: int = 0):
+        """ Initialize a query over the objects of the model class cls
+        """
+        self._cls = cls
+        self._conditions = conditions
+        self._ordering = ordering
+        self._limit = limit
+        self._offset = offset
+
+    def _copy(self, **changes) -> 'Query':
+        """ Return a copy of the query with some parameters changed
+        """
+        params = dict(conditions=self._conditions, ordering=self._ordering,
+                      limit=self._limit, offset=self._offset)
+        params.update(changes)
+        return Query(self._cls, **params)
+
+    def filter(self, **conditions) -> 'Query':
+        """ Return the query restricted to the objects matching all
+        conditions; raise ValueError on an unknown operator
+        """
+        parsed = []
+        for key, value in conditions.items():
+            attr, _, op = key.partition("__")
+            op = op or "eq"
+            if op not in OPERATORS:
+                raise ValueError("Unknown operator {}".format(op))
+            if op == "in":
+                try:
+                    value = frozenset(value)
+                except TypeError:
+                    value = tuple(value)
+            parsed.append((attr, op, value))
+        return self._copy(conditions=self._conditions + tuple(parsed))
+
+    def order_by(self, *attrs: str) -> 'Query':
+        """ Return the query ordered by attrs, `-attr` for descending
+
+        None values come after the others in ascending order, before
+        them in descending order. Ties are broken by ID, in the direction
+        of the last attribute.
+        """
+        ordering = tuple((attr[1:], True) if attr.startswith("-")
+                         else (attr, False) for attr in attrs)
+        return self._copy(ordering=ordering)
+
+    def limit(self, count: Optional[int]) -> 'Query':
+        """ Return the query returning at most count objects, all of them
+        when count is None
+        """
+        if count is not None and count < 0:
+            raise ValueError("Invalid limit")
+        return self._copy(limit=count)
+
+    def offset(self, count: int) -> 'Query':
+        """ Return the query skipping its first count objects
+        """
+        if count < 0:
+            raise ValueError("Invalid offset")
+        return self._copy(offset=count)
+
+    def __iter__(self) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the matching objects
+        """
+        _, candidates, ordered = self._plan()
+        matches = filter(self._matches, candidates)
+        stop = None if self._limit is None else self._offset + self._limit
+        if self._ordering and not ordered:
+            matches = self._sort(matches, stop)
+        return itertools.islice(matches, self._offset, stop)
+
+    def all(self) -> List[TypeVar('Base')]:
+        """ Return the matching objects
+        """
+        return list(self)
+
+    def first(self) -> Optional[TypeVar('Base')]:
+        """ Return the first matching object, None if there is none
+        """
+        return next(iter(self.limit(1)), None)
+
+    def count(self) -> int:
+        """ Count the matching objects
+        """
+        return sum(1 for _ in self)
+
+    def explain(self) -> str:
+        """ Describe how the candidates of the query are read
+        """
+        return self._plan()[0]
+
+    def _matches(self, obj: TypeVar('Base')) -> bool:
+        """ Whether obj exists and matches all conditions
+        """
+        if obj is None:
+            return False
+        for attr, op, value in self._conditions:
+            try:
+                if not OPERATORS[op](getattr(obj, attr, None), value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def _index_plan(self) -> Optional[Tuple[int, str, List[dict]]]:
+        """ Return the size, description and buckets of the smallest
+        index lookup answering a condition, None without any
+        """
+        best = None
+        for attr, op, value in self._conditions:
+            index = self._cls._index(attr)
+            if index is None or op not in INDEX_OPERATORS:
+                continue
+            try:
+                if op == "eq":
+                    buckets = [index.get(value, {})]
+                elif op == "in":
+                    buckets = [index.get(item, {}) for item in value]
+                else:
+                    buckets = [bucket for key, bucket in list(index.items())
+                               if _prefix(key, value)]
+            except TypeError:
+                continue
+            size = sum(len(bucket) for bucket in buckets)
+            if best is None or size < best[0]:
+                best = (size, "index {} {}".format(attr, op), buckets)
+        return best
+
+    def _walk_bounds(self, keys: List[Tuple[str, str]]) -> Tuple[int, int]:
+        """ Return the range of the sorted (created_at, id) keys that the
+        creation date conditions allow
+        """
+        low, high = 0, len(keys)
+        for attr, op, value in self._conditions:
+            if attr != ORDER_ATTRIBUTE or type(value) is not datetime:
+                continue
+            # "\0" sorts before the fraction of any later timestamp
+            # sharing these seconds, and after the timestamp itself
+            timestamp = value.isoformat()
+            if op == "gt":
+                low = max(low, bisect.bisect_left(keys, (timestamp + "\0",)))
+            elif op == "gte":
+                low = max(low, bisect.bisect_left(keys, (timestamp,)))
+            elif op == "lt":
+                high = min(high, bisect.bisect_left(keys, (timestamp,)))
+            elif op == "lte":
+                high = min(high,
+                           bisect.bisect_left(keys, (timestamp + "\0",)))
+        return low, max(low, high)
+
+    def _walkable(self) -> bool:
+        """ Whether the ordering is the creation date order of the model
+        """
+        if not self._ordering or self._ordering[0][0] != ORDER_ATTRIBUTE:
+            return False
+        descending = self._ordering[0][1]
+        return self._ordering[1:] in ((), (("id", descending),))
+
+    def _plan(self) -> Tuple[str, Iterable, bool]:
+        """ Return the description of the plan, the candidate objects
+        and whether they're already in the query order
+        """
+        objs = self._cls._objects()
+        index_plan = self._index_plan()
+        walkable = self._walkable()
+        filtered_by_date = any(attr == ORDER_ATTRIBUTE
+                               for attr, _, _ in self._conditions)
+        if walkable or filtered_by_date:
+            keys = self._cls._order_keys(objs)
+            low, high = self._walk_bounds(keys)
+            cost = high - low
+            if walkable and self._limit is not None and \
+                    index_plan is not None:
+                # matches are expected at the rate of the index lookup
+                wanted = self._offset + self._limit
+                cost = min(cost, wanted * cost // max(index_plan[0], 1))
+            if index_plan is None or cost < index_plan[0]:
+                if walkable and self._ordering[0][1]:
+                    positions = range(high - 1, low - 1, -1)
+                else:
+                    positions = range(low, high)
+                candidates = (objs.get(keys[position][1])
+                              for position in positions)
+                return ("walk {}".format(ORDER_ATTRIBUTE), candidates,
+                        walkable)
+
+        if index_plan is not None:
+            _, description, buckets = index_plan
+            ids = dict.fromkeys(obj_id for bucket in buckets
+                                for obj_id in list(bucket))
+            return description, (objs.get(obj_id) for obj_id in ids), False
+        return "scan", objs.values(), False
+
+    def _sort(self, matches: Iterable[TypeVar('Base')],
+              stop: Optional[int]) -> List[TypeVar('Base')]:
+        """ Return the first stop objects of matches in the query order,
+        all of them when stop is None
+        """
+        directions = {descending for _, descending in self._ordering}
+        if len(directions) == 1:
+            attrs = [attr for attr, _ in self._ordering]
+
+            def key(obj):
+                return tuple(_sort_value(getattr(obj, attr, None))
+                             for attr in attrs) + (obj.id,)
+            if directions == {True}:
+                if stop is not None:
+                    return heapq.nlargest(stop, matches, key=key)
+                return sorted(matches, key=key, reverse=True)
+            if stop is not None:
+                return heapq.nsmallest(stop, matches, key=key)
+            return sorted(matches, key=key)
+
+        # mixed directions: stable sorts from the last key to the first
+        objs = sorted(matches, key=lambda obj: obj.id,
+                      reverse=self._ordering[-1][1])
+        for attr, descending in reversed(self._ordering):
+            objs.sort(key=lambda obj: _sort_value(getattr(obj, attr, None)),
+                      reverse=descending)
+        return objs
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+""" Binary snapshot module
+
+Layout, little endian:
+  - header: magic b"HBDB", u16 version, u32 shape count, then each
+    shape: u16 field count and per field its key (u16 length + UTF-8
+    bytes) and a u8 type tag; then u32 record count
+  - records: u32 length, u16 shape index, the fixed part then the text
+    part. The fixed part holds, in field order, an i64 count of
+    microseconds since the Unix epoch for TAG_DATETIME, the i64 value
+    of TAG_INT and an u32 length in characters for TAG_STR and
+    TAG_JSON; TAG_NONE fields take no space. The text part is the UTF-8
+    concatenation of the TAG_STR values and of the JSON text of the
+    TAG_JSON values.
+
+Records sharing their keys and value types share a shape, so decoding
+a record takes one struct unpack and one UTF-8 decode. Version 1 files,
+without TAG_INT, are still read.
+"""
+from datetime import datetime, timedelta
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+import json
+import struct
+
+
+MAGIC = b"HBDB"
+VERSION = 2
+READ_VERSIONS = (1, VERSION)
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+TAG_NONE = 0
+TAG_STR = 1
+TAG_DATETIME = 2
+TAG_JSON = 3
+TAG_INT = 4
+_FIXED_FORMATS = {TAG_NONE: "", TAG_STR: "I", TAG_DATETIME: "q",
+                  TAG_JSON: "I", TAG_INT: "q"}
+INT_RANGE = range(-2 ** 63, 2 ** 63)
+
+_HEADER = struct.Struct("<4sHI")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_RECORD = struct.Struct("<IH")
+
+
+class SnapshotError(ValueError):
+    """ Raised on a file that isn't a snapshot of a supported version
+    """
+
+
+def _tag(value) -> int:
+    """ Return the type tag of a value
+    """
+    if value is None:
+        return TAG_NONE
+    if type(value) is str:
+        return TAG_STR
+    if type(value) is datetime:
+        return TAG_DATETIME
+    if type(value) is int and value in INT_RANGE:
+        return TAG_INT
+    return TAG_JSON
+
+
+def _fixed_struct(tags: Iterable[int]) -> struct.Struct:
+    """ Return the struct of the fixed part of a shape
+    """
+    return struct.Struct("<" + "".join(_FIXED_FORMATS[tag] for tag in tags))
+
+
+def dump(records: Iterable[dict], f: BinaryIO):
+    """ Write records, dictionaries of attributes, as a snapshot
+    """
+    shapes = {}
+    encoded = []
+    for record in records:
+        shape = tuple((key, _tag(value)) for key, value in record.items())
+        shape_index = shapes.setdefault(shape, len(shapes))
+        fixed = []
+        texts = []
+        for (_, tag), value in zip(shape, record.values()):
+            if tag == TAG_DATETIME:
+                fixed.append((value - EPOCH) // MICROSECOND)
+            elif tag == TAG_INT:
+                fixed.append(value)
+            elif tag != TAG_NONE:
+                text = value if tag == TAG_STR else json.dumps(value)
+                fixed.append(len(text))
+                texts.append(text)
+        encoded.append((shape_index, fixed, "".join(texts).encode()))
+
+    chunks = [_HEADER.pack(MAGIC, VERSION, len(shapes))]
+    structs = []
+    for shape in shapes:
+        chunks.append(_U16.pack(len(shape)))
+        for key, tag in shape:
+            data = key.encode()
+            chunks.append(_U16.pack(len(data)) + data + bytes((tag,)))
+        structs.append(_fixed_struct(tag for _, tag in shape))
+    chunks.append(_U32.pack(len(encoded)))
+    f.write(b"".join(chunks))
+
+    for shape_index, fixed, text in encoded:
+        fixed_struct = structs[shape_index]
+        length = _U16.size + fixed_struct.size + len(text)
+        f.write(_RECORD.pack(length, shape_index) +
+                fixed_struct.pack(*fixed) + text)
+
+
+def _read_shapes(view: memoryview,
+                 shape_count: int) -> Tuple[List[tuple], int]:
+    """ Return the shapes of the header, as (fields, fixed struct) pairs,
+    and the offset following them
+    """
+    offset = _HEADER.size
+    shapes = []
+    for _ in range(shape_count):
+        field_count, = _U16.unpack_from(view, offset)
+        offset += _U16.size
+        fields = []
+        for _ in range(field_count):
+            length, = _U16.unpack_from(view, offset)
+            offset += _U16.size
+            key = str(view[offset:offset + length], "utf-8")
+            offset += length
+            tag = view[offset]
+            offset += 1
+            if tag not in _FIXED_FORMATS:
+                raise SnapshotError("Unknown value type {}".format(tag))
+            fields.append((key, tag))
+        shapes.append((fields, _fixed_struct(tag for _, tag in fields)))
+    return shapes, offset
+
+
+def load(data) -> Iterator[dict]:
+    """ Iterate over the records of a snapshot
+
+    data is any buffer, such as the bytes or an mmap of the file. Values
+    are read from a memoryview of it: strings are decoded in place and
+    timestamps come back as datetime objects. The view is released when
+    the iteration ends.
+    """
+    with memoryview(data) as view:
+        yield from _load_records(view)
+
+
+def _load_records(view: memoryview) -> Iterator[dict]:
+    """ Iterate over the records of the snapshot in view
+    """
+    if len(view) < _HEADER.size:
+        raise SnapshotError("Truncated snapshot header")
+    magic, version, shape_count = _HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise SnapshotError("Not a snapshot file")
+    if version not in READ_VERSIONS:
+        raise SnapshotError(
+            "Unsupported snapshot version {}".format(version))
+    shapes, offset = _read_shapes(view, shape_count)
+    record_count, = _U32.unpack_from(view, offset)
+    offset += _U32.size
+
+    unpack_record = _RECORD.unpack_from
+    for _ in range(record_count):
+        length, shape_index = unpack_record(view, offset)
+        end = offset + _U32.size + length
+        fields, fixed_struct = shapes[shape_index]
+        fixed = fixed_struct.unpack_from(view, offset + _RECORD.size)
+        text = str(view[offset + _RECORD.size + fixed_struct.size:end],
+                   "utf-8")
+        offset = end
+
+        record = {}
+        position = 0
+        i = 0
+        for key, tag in fields:
+            if tag == TAG_STR:
+                start, position = position, position + fixed[i]
+                record[key] = text[start:position]
+                i += 1
+            elif tag == TAG_DATETIME:
+                record[key] = EPOCH + fixed[i] * MICROSECOND
+                i += 1
+            elif tag == TAG_INT:
+                record[key] = fixed[i]
+                i += 1
+            elif tag == TAG_NONE:
+                record[key] = None
+            else:
+                start, position = position, position + fixed[i]
+                record[key] = json.loads(text[start:position])
+                i += 1
+        if position != len(text):
+            raise SnapshotError("Corrupted snapshot record")
+        yield record
@@ -2,38 +2,590 @@
 """ Base module
 """
 from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from collections.abc import ItemsView, Mapping, MutableMapping, ValuesView
+from typing import TypeVar, BinaryIO, Dict, Iterator, List, Iterable, \
+    Optional, Tuple
+from os import getenv, path
+import atexit
+import base64
+import bisect
+import contextlib
+import fcntl
 import json
+import logging
+import mmap
+import os
+import threading
+import time
 import uuid
+import warnings
+
+from models import snapshot
+from models.query import Query
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# class name -> id -> object. The mappings are never changed once
+# published: writers hold WRITE_LOCK, change a copy and swap it in, so
+# readers iterate a consistent snapshot without locking. LayeredDict
+# copies share most of their entries
 DATA = {}
+WRITE_LOCK = threading.RLock()
+# class name -> (objects mapping, to_json() list of its objects)
+JSON_LISTS = {}
+# class name -> (objects mapping, sorted (created_at, id) of its objects)
+ORDER_KEYS = {}
+# class name -> number of writes since start, bumped after the swap
+VERSIONS = {}
+# versions restart at 0, so class ETags also identify the process run
+RUN_ID = uuid.uuid4().hex
+# class name -> attribute -> value -> {id: None}, ordered set of ids.
+# Like DATA, published indexes and buckets are never changed: writers
+# take LayeredDict copies of the indexes and of the buckets they change
+# and swap them in with the objects
+INDEXES = {}
+# class name -> id -> attribute -> value the object is indexed under
+INDEXED_VALUES = {}
+# "file" rewrites .db_<Class>.json on each write, "journal" appends the
+# write to .db_<Class>.journal and compacts it into the snapshot,
+# "write_behind" rewrites .db_<Class>.json from a background thread
+STORAGE_MODE = getenv("MODELS_STORAGE_MODE", "file")
+JOURNAL_COMPACT_SIZE = int(getenv("MODELS_JOURNAL_COMPACT_SIZE",
+                                  16 * 1024 * 1024))
+FLUSH_INTERVAL = float(getenv("MODELS_FLUSH_INTERVAL", 0.1))
+FLUSH_THRESHOLD = int(getenv("MODELS_FLUSH_THRESHOLD", 100))
+# keep the loaded JSON records and build objects on first access
+LAZY_LOAD = bool(int(getenv("MODELS_LAZY_LOAD", 0)))
+# "json" for .db_<Class>.json, "binary" for the .db_<Class>.bin snapshot
+SNAPSHOT_FORMAT = getenv("MODELS_SNAPSHOT_FORMAT", "json")
+SNAPSHOT_EXTENSIONS = {"json": "json", "binary": "bin"}
+# share the class files between processes: writes are journaled under
+# an exclusive lock of .db_<Class>.lock, and reads first apply the
+# journal entries appended by the other processes
+SHARED = bool(int(getenv("MODELS_SHARED", 0)))
+# class name -> (snapshot files signature, journal inode, journal offset)
+# of the files state the loaded objects reflect
+DISK_STATES = {}
+# classes whose lock file is held by this process
+LOCKED_CLASSES = set()
+
+
+def _json_record(record: dict) -> dict:
+    """ Return a loaded record with its timestamps formatted for JSON
+    """
+    return {key: value.strftime(TIMESTAMP_FORMAT)
+            if type(value) is datetime else value
+            for key, value in record.items()}
+
+
+def _public_json(obj) -> dict:
+    """ Return the to_json() dictionary of an object or loaded record,
+    without building the object of a record
+    """
+    if type(obj) is dict:
+        return {key: value for key, value in _json_record(obj).items()
+                if key[0] != '_'}
+    return obj.to_json()
+
+
+# value of the entries removed from the base of a LayeredDict
+_REMOVED = object()
+_MISSING = object()
+# changes a LayeredDict keeps whatever its size before merging them
+MERGE_MIN_CHANGES = 32
+
+
+class LayeredDict(MutableMapping):
+    """ Dictionary whose copies share most of their entries
+
+    Entries are read from a base dictionary, shared by the copies and
+    never changed, overlaid with the changes made since it was built.
+    A copy only copies the changes, and merges them into a new base
+    once they outnumber the square root of the base size: copying then
+    changing a few entries takes O(sqrt(n)) amortized time, not O(n).
+    Iterating merges them too, so it runs at dict speed; it follows the
+    base order, then the order of the added keys.
+    """
+    __slots__ = ('_base', '_changes', '_len')
+
+    def __init__(self, base: dict = None):
+        """ Initialize the dictionary over base, which mustn't be changed
+        afterwards
+        """
+        self._base = {} if base is None else base
+        self._changes = {}
+        self._len = len(self._base)
+
+    def __getitem__(self, key):
+        """ Return the value of key
+        """
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self._base[key]
+        if value is _REMOVED:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        """ Return the value of key, default if it's missing
+        """
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            return self._base.get(key, default)
+        if value is _REMOVED:
+            return default
+        return value
+
+    def __contains__(self, key) -> bool:
+        """ Whether key has a value
+        """
+        value = self._changes.get(key, _MISSING)
+        if value is _MISSING:
+            return key in self._base
+        return value is not _REMOVED
+
+    def __setitem__(self, key, value):
+        """ Set the value of key
+        """
+        if key not in self:
+            self._len += 1
+        self._changes[key] = value
+
+    def __delitem__(self, key):
+        """ Remove key
+        """
+        if key not in self:
+            raise KeyError(key)
+        if key in self._base:
+            self._changes[key] = _REMOVED
+        else:
+            del self._changes[key]
+        self._len -= 1
+
+    def __iter__(self) -> Iterator:
+        """ Iterate over the keys
+        """
+        return iter(self._merged())
+
+    def __len__(self) -> int:
+        """ Number of entries
+        """
+        return self._len
+
+    def _merged(self) -> dict:
+        """ Return the entries as a dict, the base once the changes are
+        merged into a new one
+
+        Merging doesn't change the entries, so it's safe on a published
+        dictionary: concurrent readers find the same entries before,
+        during and after it.
+        """
+        # changes read before the base: a base merged meanwhile by
+        # another reader already holds them
+        changes = self._changes
+        if changes:
+            merged = dict(self._base)
+            for key, value in changes.items():
+                if value is _REMOVED:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+            # base first: until the changes are dropped, they agree with it
+            self._base = merged
+            self._changes = {}
+        return self._base
+
+    def items(self) -> ItemsView:
+        """ View of the (key, value) pairs
+        """
+        return _LayeredItems(self)
+
+    def values(self) -> ValuesView:
+        """ View of the values
+        """
+        return _LayeredValues(self)
+
+    def copy(self) -> 'LayeredDict':
+        """ Shallow copy, sharing the base
+        """
+        if len(self._changes) > MERGE_MIN_CHANGES and \
+                len(self._changes) ** 2 > len(self._base):
+            self._merged()
+        changes = self._changes
+        result = LayeredDict.__new__(LayeredDict)
+        result._base = self._base
+        result._changes = dict(changes)
+        result._len = self._len
+        return result
+
+
+class _LayeredItems(ItemsView):
+    """ Items view of a LayeredDict
+    """
+
+    def __iter__(self) -> Iterator[tuple]:
+        """ Iterate over the (key, value) pairs
+        """
+        return iter(self._mapping._merged().items())
+
+
+class _LayeredValues(ValuesView):
+    """ Values view of a LayeredDict
+    """
+
+    def __iter__(self) -> Iterator:
+        """ Iterate over the values
+        """
+        return iter(self._mapping._merged().values())
+
+
+def _private_copy(mapping: Mapping) -> MutableMapping:
+    """ Return a copy of a published mapping, to change without changing
+    it: LayeredDict and LazyObjects copies share most entries, and a
+    dict, never changed once published, becomes the base of a LayeredDict
+    """
+    if isinstance(mapping, (LayeredDict, LazyObjects)):
+        return mapping.copy()
+    return LayeredDict(mapping)
+
+
+class LazyObjects(MutableMapping):
+    """ Objects of a class by ID, for lazy loading
+
+    Values are either objects or the raw JSON records they were loaded
+    from; a record is turned into an object the first time it's read.
+    Counting, membership and serialization don't build any object.
+    Copies share the objects built, so a record read through several
+    snapshots of the store gives the same object; removing an object
+    from a copy leaves the shared objects to the other snapshots.
+    """
+
+    def __init__(self, cls: type, items: dict = None, built: dict = None,
+                 lock: threading.Lock = None):
+        """ Initialize the mapping for the model class cls
+        """
+        self._cls = cls
+        self._items = LayeredDict() if items is None else items
+        # id -> (record, object built from it), shared by the copies
+        self._built = {} if built is None else built
+        self._lock = threading.Lock() if lock is None else lock
+
+    def __getitem__(self, obj_id: str) -> TypeVar('Base'):
+        """ Return the object, built from its record if needed
+        """
+        obj = self._items[obj_id]
+        if type(obj) is not dict:
+            return obj
+        with self._lock:
+            record, built = self._built.get(obj_id, (None, None))
+            if record is not obj:
+                built = self._cls(**obj)
+                self._built[obj_id] = (obj, built)
+        return built
+
+    def __setitem__(self, obj_id: str, obj):
+        """ Store an object or a raw JSON record
+        """
+        self._items[obj_id] = obj
+
+    def __delitem__(self, obj_id: str):
+        """ Remove an object
+        """
+        del self._items[obj_id]
+
+    def pop(self, obj_id: str, *default):
+        """ Remove an object and return it, or its raw JSON record if it
+        wasn't built, without building it
+        """
+        return self._items.pop(obj_id, *default)
+
+    def __contains__(self, obj_id: str) -> bool:
+        """ Membership without building the object
+        """
+        return obj_id in self._items
+
+    def __iter__(self) -> Iterator[str]:
+        """ Iterate over the IDs
+        """
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        """ Number of objects
+        """
+        return len(self._items)
+
+    def copy(self) -> 'LazyObjects':
+        """ Shallow copy, sharing the objects built
+        """
+        return LazyObjects(self._cls, self._items.copy(), self._built,
+                           self._lock)
+
+    def raw_items(self) -> Iterator[tuple]:
+        """ Iterate over (id, object or raw JSON record) pairs
+        """
+        return iter(list(self._items.items()))
+
+
+class WriteBehind():
+    """ Group commit of the class files
+
+    Writes mark their class dirty; a background thread rewrites the
+    file of each dirty class once FLUSH_INTERVAL seconds have passed or
+    FLUSH_THRESHOLD writes are pending, whichever comes first. Failed
+    flushes are logged and retried, and make the waits for the writes
+    they held raise.
+    """
+
+    def __init__(self):
+        """ Initialize the writer
+        """
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._dirty = {}
+        self._written = {}
+        self._flushed = {}
+        # class name -> (last generation of the failed flush, exception)
+        self._errors = {}
+        self._thread = None
+
+    def mark_dirty(self, cls: type) -> int:
+        """ Record a write of cls and return its generation number
+        """
+        s_class = cls.__name__
+        with self._cond:
+            generation = self._written.get(s_class, 0) + 1
+            self._written[s_class] = generation
+            pending = self._dirty.get(s_class, (cls, 0))[1] + 1
+            self._dirty[s_class] = (cls, pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="write-behind",
+                                                daemon=True)
+                self._thread.start()
+            # wake the thread idle without dirty class, or the flush due
+            if pending == 1 or pending >= FLUSH_THRESHOLD:
+                self._cond.notify_all()
+            return generation
+
+    def wait(self, cls: type, generation: int = None):
+        """ Block until the write `generation` of cls, by default the
+        latest one, is on disk; raise OSError if the flush meant to
+        write it failed
+        """
+        s_class = cls.__name__
+        with self._cond:
+            if generation is None:
+                generation = self._written.get(s_class, 0)
+            while self._flushed.get(s_class, 0) < generation:
+                failed, error = self._errors.get(s_class, (0, None))
+                if failed >= generation:
+                    raise OSError("Can't write the {} file: {}".format(
+                        s_class, error)) from error
+                self._cond.wait()
+
+    def flush(self, cls: type = None):
+        """ Write the files of all dirty classes now, or only of cls
+        """
+        with self._flush_lock:
+            with self._cond:
+                if cls is None:
+                    dirty, self._dirty = self._dirty, {}
+                else:
+                    dirty = {}
+                    if cls.__name__ in self._dirty:
+                        dirty[cls.__name__] = self._dirty.pop(cls.__name__)
+                generations = {s_class: self._written[s_class]
+                               for s_class in dirty}
+            flushed = {}
+            errors = {}
+            try:
+                for s_class, (cls, _) in dirty.items():
+                    try:
+                        cls.save_to_file()
+                    except Exception as e:
+                        logging.getLogger(__name__).exception(
+                            "Write-behind flush of %s failed", s_class)
+                        errors[s_class] = (generations[s_class], e)
+                        continue
+                    flushed[s_class] = generations[s_class]
+            finally:
+                with self._cond:
+                    for s_class, (cls, pending) in dirty.items():
+                        if s_class not in flushed:
+                            self._dirty.setdefault(s_class, (cls, pending))
+                        else:
+                            self._errors.pop(s_class, None)
+                    self._flushed.update(flushed)
+                    self._errors.update(errors)
+                    self._cond.notify_all()
+            if errors:
+                raise next(iter(errors.values()))[1]
+
+    def _due(self) -> bool:
+        """ Whether a class has reached FLUSH_THRESHOLD pending writes
+        """
+        return any(pending >= FLUSH_THRESHOLD
+                   for _, pending in self._dirty.values())
+
+    def _run(self):
+        """ Flush loop of the background thread
+        """
+        while True:
+            with self._cond:
+                while not self._dirty:
+                    self._cond.wait()
+                deadline = time.monotonic() + FLUSH_INTERVAL
+                while not self._due():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self.flush()
+            except Exception:
+                time.sleep(FLUSH_INTERVAL)
+
+
+WRITE_BEHIND = WriteBehind()
+atexit.register(WRITE_BEHIND.flush)
+
+
+def _file_signature(file_path: str) -> Optional[Tuple[int, int, int]]:
+    """ Return the (inode, mtime, size) of a file, None if missing
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _read_journal(f: BinaryIO) -> Tuple[List[dict], int]:
+    """ Return the entries of a journal from its position, and the number
+    of bytes they take
+
+    Reading stops at a torn line, of an interrupted or ongoing append.
+    Complete lines that don't decode, a torn line that later appends
+    were merged into, are skipped.
+    """
+    entries = []
+    size = 0
+    for line in f:
+        if not line.endswith(b"\n"):
+            break
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            pass
+        size += len(line)
+    return entries, size
+
+
+def _truncate_journal(journal_path: str, inode: int, offset: int):
+    """ Cut the journal back to offset, the end of its last entry read,
+    so the torn line of an interrupted append isn't followed by the next
+    appends; the caller holds the lock of the class
+    """
+    try:
+        f = open(journal_path, 'r+b')
+    except FileNotFoundError:
+        return
+    with f:
+        stat = os.fstat(f.fileno())
+        if stat.st_ino == inode and stat.st_size > offset:
+            f.truncate(offset)
+
+
+def _index_insert(indexes: dict, indexed_values: dict, obj_id: str,
+                  values: dict):
+    """ Add an object to the indexes of a class under its attribute values
+    """
+    for attr, value in values.items():
+        bucket = indexes.setdefault(attr, {}).setdefault(value, {})
+        bucket[obj_id] = None
+    indexed_values[obj_id] = values
+
+
+def _order_key(obj_id: str, obj) -> Tuple[str, str]:
+    """ Return the (created_at, id) key ordering an object or raw record
+    """
+    created_at = obj.get("created_at") if type(obj) is dict \
+        else obj.created_at
+    if type(created_at) is datetime:
+        # TIMESTAMP_FORMAT, with the microseconds when there are some
+        created_at = created_at.isoformat()
+    return (created_at or "", obj_id)
+
+
+def _encode_cursor(key: Tuple[str, str]) -> str:
+    """ Return the opaque cursor of an order key
+    """
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    """ Return the order key of a cursor, raise ValueError if invalid
+    """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if type(key) is not list or len(key) != 2 or \
+            not all(type(part) is str for part in key):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+
+_set_attribute = object.__setattr__
+
+
+def _slot_names(cls: type) -> Tuple[str, ...]:
+    """ Return the attribute slots of cls and its bases, bases first
+    """
+    names = cls.__dict__.get("_slot_names")
+    if names is None:
+        names = tuple(name for klass in reversed(cls.__mro__)
+                      for name in klass.__dict__.get("__slots__", ())
+                      if name not in ("__dict__", "__weakref__", "_json"))
+        cls._slot_names = names
+    return names
 
 
 class Base():
     """ Base class
+
+    Attributes are stored in __slots__, declared by each subclass for
+    its own attributes. Subclasses declare secondary indexes in
+    `indexes`, mapping an attribute name to whether its values are
+    unique. Indexes follow the saved state of the objects.
+    `_revision` counts the saves of the object and is persisted with it.
+    The `_json` slot memoizes to_json() and isn't an attribute.
     """
+    __slots__ = ('id', 'created_at', 'updated_at', '_revision', '_json')
+    indexes: Dict[str, bool] = {}
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
         s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
+        DATA.setdefault(s_class, {})
 
-        self.id = kwargs.get('id', str(uuid.uuid4()))
-        if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+        self.id = kwargs['id'] if 'id' in kwargs else str(uuid.uuid4())
+        created_at = kwargs.get('created_at')
+        if type(created_at) is datetime:
+            self.created_at = created_at
+        elif created_at is not None:
+            self.created_at = datetime.strptime(created_at, TIMESTAMP_FORMAT)
         else:
             self.created_at = datetime.utcnow()
-        if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+        updated_at = kwargs.get('updated_at')
+        if type(updated_at) is datetime:
+            self.updated_at = updated_at
+        elif updated_at is not None:
+            self.updated_at = datetime.strptime(updated_at, TIMESTAMP_FORMAT)
         else:
             self.updated_at = datetime.utcnow()
+        self._revision = kwargs.get('_revision', 0)
 
     def __eq__(self, other: TypeVar('Base')) -> bool:
         """ Equality
@@ -44,11 +596,33 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, dropping the memoized JSON dictionaries
+        """
+        _set_attribute(self, name, value)
+        if name != '_json':
+            _set_attribute(self, '_json', None)
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
+
+        The dictionary is memoized until an attribute is set.
+        """
+        cache = getattr(self, '_json', None)
+        if cache is None:
+            cache = {}
+            _set_attribute(self, '_json', cache)
+        result = cache.get(for_serialization)
+        if result is None:
+            result = self._build_json(for_serialization)
+            cache[for_serialization] = result
+        return dict(result)
+
+    def _build_json(self, for_serialization: bool) -> dict:
+        """ Convert the object a JSON dictionary, without memoization
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self.attributes():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -57,56 +631,504 @@ class Base():
                 result[key] = value
         return result
 
+    def attributes(self) -> Iterator[Tuple[str, object]]:
+        """ Iterate over the (name, value) pairs of the set attributes
+        """
+        for name in _slot_names(self.__class__):
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                continue
+        if hasattr(self, '__dict__'):
+            yield from self.__dict__.items()
+
+    def etag(self) -> str:
+        """ Return the entity tag of the object, from its ID and
+        revision
+
+        Unlike updated_at, persisted without its microseconds, the
+        revision tells apart saves within a second in every process.
+        """
+        return "{}-{}".format(self.id, self._revision)
+
+    @classmethod
+    def version(cls) -> int:
+        """ Return the number of writes to the class since start
+        """
+        return VERSIONS.get(cls.__name__, 0)
+
+    @classmethod
+    def class_etag(cls) -> str:
+        """ Return the entity tag of all objects of the class, changed by
+        any write
+
+        Read it before the objects: writes bump the version after
+        swapping in the new objects. In SHARED mode, it's derived from
+        the state of the class files, the same in all processes.
+        """
+        if SHARED:
+            cls.refresh()
+            return "{}-{}-{}".format(*DISK_STATES[cls.__name__])
+        return "{}-{}".format(RUN_ID, cls.version())
+
+    def to_record(self) -> dict:
+        """ Convert the object to a dictionary of all its attributes,
+        timestamps kept as datetime
+        """
+        return dict(self.attributes())
+
+    @classmethod
+    def snapshot_path(cls, snapshot_format: str = None) -> str:
+        """ Path of the class file in snapshot_format, SNAPSHOT_FORMAT by
+        default
+        """
+        extension = SNAPSHOT_EXTENSIONS[snapshot_format or SNAPSHOT_FORMAT]
+        return ".db_{}.{}".format(cls.__name__, extension)
+
+    @classmethod
+    def _read_snapshot(cls, snapshot_format: str) -> Iterable[dict]:
+        """ Return the records of the class file in snapshot_format
+        """
+        file_path = cls.snapshot_path(snapshot_format)
+        if snapshot_format == "binary":
+            with open(file_path, 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    # empty files can't be mapped
+                    yield from snapshot.load(b"")
+                    return
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    yield from snapshot.load(m)
+            return
+        with open(file_path, 'r') as f:
+            yield from json.load(f).values()
+
+    @classmethod
+    def load_from_file(cls, snapshot_format: str = None):
+        """ Load all objects from file, then replay the journal
+
+        The file in snapshot_format, SNAPSHOT_FORMAT by default, is read
+        if it exists, else the file in the other format. Writes still
+        pending in write_behind mode are flushed first.
+        """
+        s_class = cls.__name__
+        objs = LazyObjects(cls) if LAZY_LOAD else {}
+        snapshot_format = snapshot_format or SNAPSHOT_FORMAT
+        formats = [snapshot_format] + [other for other in SNAPSHOT_EXTENSIONS
+                                       if other != snapshot_format]
+        with cls._write_lock():
+            WRITE_BEHIND.flush(cls)
+            signature = cls._snapshot_signature()
+            for file_format in formats:
+                if not path.exists(cls.snapshot_path(file_format)):
+                    continue
+                for record in cls._read_snapshot(file_format):
+                    if LAZY_LOAD:
+                        objs[record["id"]] = record
+                    else:
+                        objs[record["id"]] = cls(**record)
+                break
+            inode, offset = cls.replay_journal(objs)
+            if inode is not None:
+                _truncate_journal(".db_{}.journal".format(s_class), inode,
+                                  offset)
+            cls._swap(objs, *cls.rebuild_indexes(objs))
+            DISK_STATES[s_class] = (signature, inode, offset)
+
+    @classmethod
+    def replay_journal(cls, objs: MutableMapping) -> Tuple[int, int]:
+        """ Apply the journaled writes on top of the objects loaded in objs
+
+        Returns the inode of the journal and the offset following the
+        last entry applied, (None, 0) without journal.
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        try:
+            f = open(journal_path, 'rb')
+        except FileNotFoundError:
+            return None, 0
+
+        with f:
+            entries, offset = _read_journal(f)
+            inode = os.fstat(f.fileno()).st_ino
+        for entry in entries:
+            if entry["op"] == "save" and LAZY_LOAD:
+                objs[entry["id"]] = entry["obj"]
+            elif entry["op"] == "save":
+                objs[entry["id"]] = cls(**entry["obj"])
+            else:
+                objs.pop(entry["id"], None)
+        return inode, offset
+
+    @classmethod
+    def _snapshot_signature(cls) -> tuple:
+        """ Return the _file_signature of the class file in each format
+        """
+        return tuple(_file_signature(cls.snapshot_path(snapshot_format))
+                     for snapshot_format in SNAPSHOT_EXTENSIONS)
+
     @classmethod
-    def load_from_file(cls):
-        """ Load all objects from file
+    @contextlib.contextmanager
+    def _write_lock(cls):
+        """ Hold WRITE_LOCK and, in SHARED mode, the lock file of the class
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
+        with WRITE_LOCK:
+            if not SHARED or s_class in LOCKED_CLASSES:
+                yield
+                return
+            with open(".db_{}.lock".format(s_class), 'a') as f:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                LOCKED_CLASSES.add(s_class)
+                try:
+                    yield
+                finally:
+                    LOCKED_CLASSES.discard(s_class)
+
+    @classmethod
+    def refresh(cls):
+        """ Catch up with the writes of the other processes in SHARED mode
+
+        Checking for changes takes a few stat calls. The journal entries
+        appended since the last read are applied to the loaded objects;
+        the class file is only read again when it has been rewritten.
+        """
+        if not SHARED:
+            return
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        state = DISK_STATES.get(s_class)
+        journal = _file_signature(journal_path)
+        if state is not None and state[0] == cls._snapshot_signature() \
+                and (journal or (None,))[0] == state[1] \
+                and (journal or (0, 0, 0))[2] == state[2]:
             return
 
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        with WRITE_LOCK:
+            state = DISK_STATES.get(s_class)
+            signature = cls._snapshot_signature()
+            if state is None or state[0] != signature:
+                cls.load_from_file()
+                return
+            try:
+                f = open(journal_path, 'rb')
+            except FileNotFoundError:
+                if state[1] is not None:
+                    cls.load_from_file()
+                return
+            with f:
+                inode = os.fstat(f.fileno()).st_ino
+                if state[1] is not None and state[1] != inode:
+                    cls.load_from_file()
+                    return
+                offset = state[2] if state[1] is not None else 0
+                f.seek(offset)
+                entries, size = _read_journal(f)
+            if cls._snapshot_signature() != signature:
+                # compacted meanwhile, entries may follow the new file
+                cls.load_from_file()
+                return
+            if entries:
+                cls._apply_entries(entries)
+            if s_class in LOCKED_CLASSES:
+                # no append is ongoing: a torn line is an interrupted one
+                _truncate_journal(journal_path, inode, offset + size)
+            DISK_STATES[s_class] = (signature, inode, offset + size)
 
     @classmethod
-    def save_to_file(cls):
-        """ Save all objects to file
+    def _apply_entries(cls, entries: List[dict]):
+        """ Swap in a copy of the class objects with journal entries
+        applied; the caller holds WRITE_LOCK
+        """
+        objs = _private_copy(DATA.setdefault(cls.__name__, {}))
+        changes = {}
+        for entry in entries:
+            if entry["op"] == "save":
+                obj = entry["obj"] if LAZY_LOAD else cls(**entry["obj"])
+                objs[entry["id"]] = obj
+                changes[entry["id"]] = cls._index_values(obj)
+            else:
+                objs.pop(entry["id"], None)
+                changes[entry["id"]] = None
+        cls._swap(objs, *cls._reindex(changes))
+
+    @classmethod
+    def save_to_file(cls, snapshot_format: str = None):
+        """ Save all objects to file, which makes the journal obsolete
+
+        The file is written in snapshot_format, SNAPSHOT_FORMAT by default.
+        In SHARED mode, the writes of the other processes are applied
+        first, under the lock file.
+        """
+        if SHARED:
+            with cls._write_lock():
+                cls.refresh()
+                cls._write_snapshot(snapshot_format)
+        else:
+            cls._write_snapshot(snapshot_format)
+
+    @classmethod
+    def _write_snapshot(cls, snapshot_format: str = None):
+        """ Write all objects to the class file, then remove the file in
+        the other format and the journal, both out of date
         """
         s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
+        snapshot_format = snapshot_format or SNAPSHOT_FORMAT
+        file_path = cls.snapshot_path(snapshot_format)
+        objs = DATA[s_class]
+        if isinstance(objs, LazyObjects):
+            items = objs.raw_items()
+        else:
+            items = list(objs.items())
 
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+        tmp_path = "{}.tmp".format(file_path)
+        if snapshot_format == "binary":
+            records = (obj if type(obj) is dict else obj.to_record()
+                       for _, obj in items)
+            with open(tmp_path, 'wb') as f:
+                snapshot.dump(records, f)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            objs_json = {}
+            for obj_id, obj in items:
+                if type(obj) is dict:
+                    objs_json[obj_id] = _json_record(obj)
+                else:
+                    objs_json[obj_id] = obj.to_json(True)
+            with open(tmp_path, 'w') as f:
+                json.dump(objs_json, f)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+        # removed first: a stale file of the format load_from_file prefers
+        # would otherwise be read without the journal on top of it
+        for other in SNAPSHOT_EXTENSIONS:
+            other_path = cls.snapshot_path(other)
+            if other_path != file_path and path.exists(other_path):
+                os.remove(other_path)
+        journal_path = ".db_{}.journal".format(s_class)
+        if path.exists(journal_path):
+            os.remove(journal_path)
+        DISK_STATES[s_class] = (cls._snapshot_signature(), None, 0)
 
-    def save(self):
-        """ Save current object
+    @classmethod
+    def convert_snapshot(cls, source_format: str, target_format: str):
+        """ Rewrite the class file from source_format to target_format
+        """
+        cls.load_from_file(source_format)
+        cls.save_to_file(target_format)
+
+    @classmethod
+    def append_to_journal(cls, op: str, obj: TypeVar('Base')):
+        """ Append one write to the journal, compacting it when it passes
+        JOURNAL_COMPACT_SIZE
+        """
+        s_class = cls.__name__
+        journal_path = ".db_{}.journal".format(s_class)
+        entry = {"op": op, "id": obj.id}
+        if op == "save":
+            entry["obj"] = obj.to_json(True)
+        with open(journal_path, 'ab') as f:
+            f.write(json.dumps(entry).encode() + b"\n")
+            size = f.tell()
+            inode = os.fstat(f.fileno()).st_ino
+        state = DISK_STATES.get(s_class)
+        if state is not None:
+            DISK_STATES[s_class] = (state[0], inode, size)
+        if size > JOURNAL_COMPACT_SIZE:
+            cls.save_to_file()
+
+    @classmethod
+    def rebuild_indexes(cls, objs: MutableMapping = None
+                        ) -> Tuple[dict, dict]:
+        """ Return new indexes and indexed values of all objects of objs,
+        the loaded ones by default, reading the raw records of the ones
+        not built yet; _swap publishes them
+        """
+        s_class = cls.__name__
+        indexes = {attr: {} for attr in cls.indexes}
+        indexed_values = {}
+        if objs is None:
+            objs = DATA[s_class]
+        if isinstance(objs, LazyObjects):
+            items = objs.raw_items()
+        else:
+            items = objs.items()
+        for obj_id, obj in items:
+            _index_insert(indexes, indexed_values, obj_id,
+                          cls._index_values(obj))
+        for attr, unique in cls.indexes.items():
+            duplicates = [value for value, owners in indexes[attr].items()
+                          if unique and value is not None and len(owners) > 1]
+            if duplicates:
+                # values not shown, they may be personal data
+                warnings.warn("{} unique {} values are shared by several {} "
+                              "objects, which keep them; no other object "
+                              "can take them".format(len(duplicates), attr,
+                                                     s_class),
+                              RuntimeWarning)
+        return indexes, indexed_values
+
+    @classmethod
+    def _index_values(cls, obj) -> dict:
+        """ Return the indexed attribute values of an object or raw record
+        """
+        if type(obj) is dict:
+            return {attr: obj.get(attr) for attr in cls.indexes}
+        return {attr: getattr(obj, attr, None) for attr in cls.indexes}
+
+    @classmethod
+    def _reindex(cls, changes: dict) -> Tuple[dict, dict]:
+        """ Return copies of the indexes and indexed values where the
+        objects of changes, ID -> indexed values, are indexed under their
+        new values, or removed when these are None
+
+        Only the buckets of the changed values are copied.
+        """
+        s_class = cls.__name__
+        published = INDEXES.get(s_class, {})
+        indexes = {attr: _private_copy(published.get(attr, {}))
+                   for attr in cls.indexes}
+        indexed_values = _private_copy(INDEXED_VALUES.get(s_class, {}))
+        copied = set()
+        for obj_id, values in changes.items():
+            previous = indexed_values.pop(obj_id, None) or {}
+            current = values or {}
+            for attr, index in indexes.items():
+                old = previous.get(attr, _MISSING)
+                new = current.get(attr, _MISSING)
+                if old is not _MISSING and new is not _MISSING and \
+                        old == new:
+                    continue
+                for value, add in ((old, False), (new, True)):
+                    if value is _MISSING:
+                        continue
+                    if (attr, value) not in copied:
+                        index[value] = _private_copy(index.get(value, {}))
+                        copied.add((attr, value))
+                    if add:
+                        index[value][obj_id] = None
+                    else:
+                        index[value].pop(obj_id, None)
+            if values is not None:
+                indexed_values[obj_id] = values
+        for attr, value in copied:
+            if not indexes[attr][value]:
+                del indexes[attr][value]
+        return indexes, indexed_values
+
+    def _check_unique(self):
+        """ Raise ValueError if a unique attribute is taken by another
+        object
+
+        Duplicates loaded from files written before the check existed
+        are kept: an object can always be saved with its current value.
         """
         s_class = self.__class__.__name__
-        self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        index = INDEXES.get(s_class, {})
+        indexed = INDEXED_VALUES.get(s_class, {}).get(self.id, {})
+        for attr, unique in self.__class__.indexes.items():
+            value = getattr(self, attr, None)
+            if not unique or value is None:
+                continue
+            if attr in indexed and indexed[attr] == value:
+                continue
+            owners = index.get(attr, {}).get(value, {})
+            if any(obj_id != self.id for obj_id in owners):
+                raise ValueError("{} {} already exists".format(attr, value))
+
+    @classmethod
+    def _publish(cls, obj_id: str, obj: TypeVar('Base') = None):
+        """ Swap in copies of the class objects and indexes where obj_id
+        is set to obj, or removed when obj is None; the caller holds
+        WRITE_LOCK
+        """
+        objs = _private_copy(DATA.setdefault(cls.__name__, {}))
+        if obj is None:
+            objs.pop(obj_id, None)
+            values = None
+        else:
+            objs[obj_id] = obj
+            values = cls._index_values(obj)
+        cls._swap(objs, *cls._reindex({obj_id: values}))
 
-    def remove(self):
+    @classmethod
+    def _swap(cls, objs: MutableMapping, indexes: dict,
+              indexed_values: dict):
+        """ Publish objs as the class objects, with their indexes and
+        indexed values, and bump the class version; the caller holds
+        WRITE_LOCK
+        """
+        s_class = cls.__name__
+        # indexes first: a saved object is in its buckets before readers
+        # can reach it
+        INDEXES[s_class] = indexes
+        INDEXED_VALUES[s_class] = indexed_values
+        DATA[s_class] = objs
+        JSON_LISTS.pop(s_class, None)
+        ORDER_KEYS.pop(s_class, None)
+        VERSIONS[s_class] = VERSIONS.get(s_class, 0) + 1
+
+    @classmethod
+    def _persist(cls, op: str, obj: TypeVar('Base')) -> int:
+        """ Write a save or remove of obj according to STORAGE_MODE
+
+        Returns the write_behind generation of the write, None in the
+        other modes. In SHARED mode, writes are always journaled: unlike
+        rewrites of the class file, appends of several processes merge.
+        """
+        if STORAGE_MODE == "journal" or SHARED:
+            cls.append_to_journal(op, obj)
+        elif STORAGE_MODE == "write_behind":
+            return WRITE_BEHIND.mark_dirty(cls)
+        else:
+            cls.save_to_file()
+        return None
+
+    def save(self, wait: bool = False):
+        """ Save current object
+
+        In write_behind mode, wait blocks until the write is on disk, and
+        raises OSError if the flush writing it failed.
+        """
+        cls = self.__class__
+        with cls._write_lock():
+            cls.refresh()
+            self._check_unique()
+            stored = DATA.get(cls.__name__, {}).get(self.id)
+            # this copy of the object may predate the stored one
+            self._revision = max(self._revision,
+                                 getattr(stored, '_revision', 0)) + 1
+            self.updated_at = datetime.utcnow()
+            cls._publish(self.id, self)
+            generation = cls._persist("save", self)
+        if wait and generation is not None:
+            WRITE_BEHIND.wait(cls, generation)
+
+    def remove(self, wait: bool = False):
         """ Remove object
+
+        In write_behind mode, wait blocks until the removal is on disk, and
+        raises OSError if the flush writing it failed.
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        cls = self.__class__
+        with cls._write_lock():
+            cls.refresh()
+            if self.id not in DATA.get(cls.__name__, {}):
+                return
+            cls._publish(self.id)
+            generation = cls._persist("remove", self)
+        if wait and generation is not None:
+            WRITE_BEHIND.wait(cls, generation)
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
         s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        cls.refresh()
+        return len(DATA[s_class])
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
@@ -114,16 +1136,132 @@ class Base():
         """
         return cls.search()
 
+    @classmethod
+    def to_json_list(cls) -> List[dict]:
+        """ Return the JSON dictionaries of all objects, in all() order
+
+        The list is memoized until the next write to the class and is
+        shared between callers, so it must not be modified. Records not
+        loaded as objects yet are converted without building them.
+        """
+        s_class = cls.__name__
+        cls.refresh()
+        objs = DATA.setdefault(s_class, {})
+        cached = JSON_LISTS.get(s_class)
+        if cached is not None and cached[0] is objs:
+            return cached[1]
+
+        if isinstance(objs, LazyObjects):
+            items = objs.raw_items()
+        else:
+            items = objs.items()
+        result = [_public_json(obj) for _, obj in items]
+        JSON_LISTS[s_class] = (objs, result)
+        return result
+
+    @classmethod
+    def iter_json(cls) -> Iterator[dict]:
+        """ Iterate over the JSON dictionaries of all objects, in all()
+        order, without building the whole list unless it's memoized nor
+        the objects of the records not loaded as objects yet
+        """
+        s_class = cls.__name__
+        cls.refresh()
+        objs = DATA.setdefault(s_class, {})
+        cached = JSON_LISTS.get(s_class)
+        if cached is not None and cached[0] is objs:
+            yield from cached[1]
+            return
+        if isinstance(objs, LazyObjects):
+            items = objs.raw_items()
+        else:
+            items = objs.items()
+        for _, obj in items:
+            yield _public_json(obj)
+
+    @classmethod
+    def _order_keys(cls, objs: MutableMapping) -> List[Tuple[str, str]]:
+        """ Return the sorted (created_at, id) keys of objs, memoized
+        until the next write to the class
+        """
+        s_class = cls.__name__
+        cached = ORDER_KEYS.get(s_class)
+        if cached is not None and cached[0] is objs:
+            return cached[1]
+        if isinstance(objs, LazyObjects):
+            items = objs.raw_items()
+        else:
+            items = objs.items()
+        keys = sorted(_order_key(obj_id, obj) for obj_id, obj in items)
+        ORDER_KEYS[s_class] = (objs, keys)
+        return keys
+
+    @classmethod
+    def page(cls, limit: int, after: str = None, attributes: dict = None) \
+            -> Tuple[List[TypeVar('Base')], Optional[str]]:
+        """ Return a page of at most limit objects, ordered by creation
+        date then ID, and the cursor of the next page
+
+        after is the cursor returned with the previous page, None for
+        the first one; the next cursor is None on the last page. Cursors
+        are opaque and stay valid when objects are added or removed.
+        With attributes, only the objects search() finds are paged.
+        Raise ValueError on an invalid limit or cursor.
+        """
+        if limit < 1:
+            raise ValueError("Invalid limit")
+        if attributes:
+            objs = {obj.id: obj for obj in cls.search(attributes)}
+            keys = sorted(_order_key(obj_id, obj)
+                          for obj_id, obj in objs.items())
+        else:
+            cls.refresh()
+            objs = DATA.setdefault(cls.__name__, {})
+            keys = cls._order_keys(objs)
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(keys, _decode_cursor(after))
+        page_keys = keys[start:start + limit]
+        next_cursor = None
+        if start + limit < len(keys):
+            next_cursor = _encode_cursor(page_keys[-1])
+        return [objs[obj_id] for _, obj_id in page_keys], next_cursor
+
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
         s_class = cls.__name__
+        cls.refresh()
         return DATA[s_class].get(id)
 
+    @classmethod
+    def query(cls) -> Query:
+        """ Return a Query over all objects, see models.query
+        """
+        return Query(cls)
+
+    @classmethod
+    def _objects(cls) -> MutableMapping:
+        """ Return the current objects of the class by ID, not to be
+        modified
+        """
+        cls.refresh()
+        return DATA.setdefault(cls.__name__, {})
+
+    @classmethod
+    def _index(cls, attr: str) -> Optional[dict]:
+        """ Return the index of attr, value -> {id: None}, None if attr
+        isn't indexed
+        """
+        return INDEXES.get(cls.__name__, {}).get(attr)
+
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
+
+        When indexed attributes are searched, only the objects of the
+        smallest matching index bucket are scanned.
         """
         s_class = cls.__name__
         def _search(obj):
@@ -133,5 +1271,17 @@ class Base():
                 if (getattr(obj, k) != v):
                     return False
             return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+
+        cls.refresh()
+        objs = DATA[s_class]
+        candidates = objs.values()
+        index = INDEXES.get(s_class, {})
+        try:
+            buckets = [index[k].get(v, {}) for k, v in attributes.items()
+                       if k in index]
+        except TypeError:
+            buckets = []
+        if buckets:
+            ids = list(min(buckets, key=len))
+            candidates = [objs[obj_id] for obj_id in ids if obj_id in objs]
+        return list(filter(_search, candidates))
@@ -1,11 +1,25 @@
 #!/usr/bin/env python3
 """Filtered Logger Module"""
+from functools import lru_cache
 import re
-from typing import List
+from typing import List, Pattern, Tuple
+
+
+@lru_cache(maxsize=128)
+def _compile(fields: Tuple[str, ...], redaction: str,
+             separator: str) -> Tuple[Pattern, str]:
+    """ Returns one alternation pattern matching every field, and its
+    replacement template """
+    names = sorted(set(fields), key=len, reverse=True)
+    alternation = "|".join(re.escape(name) for name in names)
+    pattern = re.compile(
+        f'(?P<field>{alternation})=[^{re.escape(separator)}]*')
+    return pattern, r'\g<field>=' + redaction.replace('\\', '\\\\')
 
 
 def filter_datum(fields: List[str], redaction: str, message: str, separator: str) -> str:
     """ Returns the log message obfuscated """
-    for field in fields:
-        message = re.sub(f'{field}=[^{separator}]*', f'{field}={redaction}', message)
-    return message
+    if not fields:
+        return message
+    pattern, template = _compile(tuple(fields), redaction, separator)
+    return pattern.sub(template, message)